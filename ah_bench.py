@@ -0,0 +1,585 @@
+"""通信ライブラリのベンチマーク
+実機なしで計測し、結果をjsonで出力する
+
+使い方:
+    python3 -m lib.ah_bench                     # 全て実行
+    python3 -m lib.ah_bench can_send            # 指定したものだけ実行
+    python3 -m lib.ah_bench -o result.json      # 結果をファイルに保存
+"""
+
+import argparse
+import json
+import os
+import platform
+import socket
+import struct
+import tempfile
+import threading
+import time
+import can
+import numpy as np
+
+from . import ah_capture
+from . import ah_python_can
+from . import ah_python_ether
+from . import ah_uart
+from . import recv_feedback
+
+# 基板1枚分のモータ (can_id下位4bitが0-3)
+CAN_IDS = (0x100, 0x101, 0x102, 0x103)
+
+
+class SimulatedCanMotor:
+    """virtualバス上でマイコンの代わりに応答するモータノード
+    read命令(アドレス4, 5)には can_id + 4 で現在値を返し、
+    4byteの書き込みは目標値として保持する。
+    read_multi=Trueの場合は一括read命令にも応答する
+
+    使い方:
+        with SimulatedCanMotor(channel) as node:
+            ...
+    """
+
+    def __init__(self, channel, can_ids=CAN_IDS, read_multi=False):
+        self.bus = can.Bus(interface="virtual", channel=channel)
+        self.can_ids = set(can_ids)
+        self.read_multi = read_multi
+        self.table = {can_id: {4: 0, 5: 0} for can_id in can_ids}
+        self.received = 0
+
+        self._running = False
+        self._thread = None
+
+    def __enter__(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._running = False
+        self._thread.join()
+        self.bus.shutdown()
+
+    def _run(self):
+        while self._running:
+            msg = self.bus.recv(timeout=0.01)
+            if msg is None or msg.arbitration_id not in self.can_ids:
+                continue
+            self.received += 1
+
+            table = self.table[msg.arbitration_id]
+            table_addr = msg.data[0]
+            if table_addr == ah_python_can.READ_MULTI_TABLE_ADDR:
+                if not self.read_multi:
+                    continue
+                packed = b"".join(
+                    struct.pack("<i", table.get(addr, 0))
+                    for addr in msg.data[1:msg.dlc])
+                for i in range(0, len(packed), 8):
+                    self.bus.send(
+                        can.Message(arbitration_id=msg.arbitration_id + 4,
+                                    data=packed[i:i + 8],
+                                    is_extended_id=False))
+            elif msg.dlc == 1:
+                if table_addr in (4, 5):
+                    self.bus.send(
+                        can.Message(arbitration_id=msg.arbitration_id + 4,
+                                    data=struct.pack("<i", table[table_addr]),
+                                    is_extended_id=False))
+            elif msg.dlc == 5:
+                table[table_addr] = struct.unpack_from("<i", msg.data, 1)[0]
+                # 目標値をそのまま現在値とする
+                if table_addr == 1:
+                    table[4] = table[table_addr]
+                elif table_addr == 2:
+                    table[5] = table[table_addr]
+
+
+def _percentiles(samples_sec):
+    samples_us = np.asarray(samples_sec) * 1e6
+    if len(samples_us) == 0:
+        return {}
+    p50, p90, p99 = np.percentile(samples_us, [50, 90, 99])
+    return {
+        "p50_us": float(p50),
+        "p90_us": float(p90),
+        "p99_us": float(p99),
+        "max_us": float(samples_us.max()),
+    }
+
+
+def bench_can_send(n_ticks=5000, can_ids=CAN_IDS):
+    """set_goal_velの1台ずつ送信とset_goal_vel_manyのフレームレートを比較する
+
+    Args:
+        n_ticks (int): 制御周期の回数
+        can_ids (tuple): 1周期で送信するcan_id
+
+    Returns:
+        dict: 計測結果
+    """
+    bus = can.Bus(interface="virtual", channel="ah_bench_can_send")
+    goals = {can_id: 1.234 for can_id in can_ids}
+    n_frames = n_ticks * len(goals)
+
+    try:
+        start = time.perf_counter()
+        for _ in range(n_ticks):
+            for can_id, goal in goals.items():
+                ah_python_can.set_goal_vel(can_id, goal, bus)
+        per_call_sec = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(n_ticks):
+            ah_python_can.set_goal_vel_many(goals, bus)
+        many_sec = time.perf_counter() - start
+    finally:
+        bus.shutdown()
+
+    return {
+        "frames": n_frames,
+        "per_call_frames_per_sec": n_frames / per_call_sec,
+        "many_frames_per_sec": n_frames / many_sec,
+    }
+
+
+class _NullBus:
+    """送信を捨てるバス。コーデックだけの時間を測るために使う"""
+
+    def send(self, msg):
+        pass
+
+
+class _NullSerial:
+    """書き込みを捨てるシリアル。パケット組み立てだけの時間を測るために使う"""
+
+    def write(self, data):
+        pass
+
+
+def _legacy_send_packet_4byte(can_id, table_addr, data, bus):
+    # 変更前のsend_packet_4byte (比較用)
+    data_int = int(data * 1000)
+    byte1, byte2, byte3, byte4 = ah_python_can.from_int32_to_bytes(data_int)
+    packet = [table_addr, byte1, byte2, byte3, byte4]
+    msg = can.Message(arbitration_id=can_id, data=packet, is_extended_id=False)
+    bus.send(msg)
+
+
+def _legacy_decode_frame(recv_msg):
+    # 変更前のreceive_frameのデコード部分 (比較用)
+    motor_id = (recv_msg.arbitration_id & 0x00F) - 4
+    if motor_id < 0 or motor_id > 3:
+        return None, None
+    recv_data = ((recv_msg.data[3] << 24) | (recv_msg.data[2] << 16) |
+                 (recv_msg.data[1] << 8) | (recv_msg.data[0]))
+    recv_data = struct.pack("<I", recv_data)
+    recv_data = struct.unpack("<i", recv_data)[0]
+    return recv_msg.arbitration_id - 4, recv_data
+
+
+def _ns_per_call(func, args, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        func(*args)
+    return (time.perf_counter() - start) / n * 1e9
+
+
+def bench_can_codec(n=200000):
+    """1フレームあたりのエンコード/デコード時間を変更前と比較する
+
+    Args:
+        n (int): 試行回数
+
+    Returns:
+        dict: 計測結果 [ns/frame]
+    """
+    bus = _NullBus()
+    recv_msg = can.Message(arbitration_id=0x104,
+                           data=struct.pack("<i", -123456),
+                           is_extended_id=False)
+    encode_args = (0x100, 2, -123.456, bus)
+
+    return {
+        "encode_legacy_ns": _ns_per_call(_legacy_send_packet_4byte,
+                                         encode_args, n),
+        "encode_ns": _ns_per_call(ah_python_can.send_packet_4byte,
+                                  encode_args, n),
+        "decode_legacy_ns": _ns_per_call(_legacy_decode_frame, (recv_msg,),
+                                         n),
+        "decode_ns": _ns_per_call(ah_python_can.decode_frame, (recv_msg,), n),
+    }
+
+
+class _BufferSerial:
+    """バイト列を受信データとして返すシリアル"""
+
+    def __init__(self, data):
+        self._data = data
+        self._pos = 0
+
+    @property
+    def in_waiting(self):
+        return len(self._data) - self._pos
+
+    def read(self, size=1):
+        chunk = self._data[self._pos:self._pos + size]
+        self._pos += len(chunk)
+        return chunk
+
+
+def _legacy_calc_checksum(packet_data):
+    # 変更前のcalc_checksum (比較用)
+    checksum_val = 0
+    for i in range(0, len(packet_data)):
+        checksum_val ^= packet_data[i]
+    return checksum_val
+
+
+def _legacy_uart_send_packet_4byte(motor_id, table_addr, data, ser):
+    # 変更前のah_uart.send_packet_4byte (比較用)
+    data_int = int(data * 1000)
+    byte_array = ah_uart.from_int32_to_bytes(data_int)
+    packet = [0xAA, 9, motor_id, table_addr] + byte_array
+    packet.append(_legacy_calc_checksum(packet))
+    ser.write(bytes(packet))
+
+
+def bench_uart_packet(n=200000, buffer_len=4096):
+    """uartパケットの組み立てとチェックサム計算の時間を変更前と比較する
+
+    Args:
+        n (int): 試行回数
+        buffer_len (int): まとめてチェックサムを計算するバッファ長
+
+    Returns:
+        dict: 計測結果 [ns]
+    """
+    ser = _NullSerial()
+    send_args = (1, 2, -123.456, ser)
+    buffer = bytes(range(256)) * (buffer_len // 256)
+    n_buffer = max(n // 100, 1)
+
+    return {
+        "send_packet_4byte_legacy_ns":
+            _ns_per_call(_legacy_uart_send_packet_4byte, send_args, n),
+        "send_packet_4byte_ns":
+            _ns_per_call(ah_uart.send_packet_4byte, send_args, n),
+        "checksum_buffer_legacy_ns":
+            _ns_per_call(_legacy_calc_checksum, (buffer,), n_buffer),
+        "checksum_buffer_ns":
+            _ns_per_call(ah_uart.calc_checksum, (buffer,), n_buffer),
+    }
+
+
+def bench_feedback_decode(n=50000, struct_format="<BiiiiB", chunk=4096):
+    """feedbackパケットのデコード速度をreceive_packetとFeedbackDecoderで比較する
+
+    Args:
+        n (int): パケット数
+        struct_format (str): パケットのフォーマット
+        chunk (int): FeedbackDecoderが1回に読み込む最大バイト数
+
+    Returns:
+        dict: 計測結果 [packets/s]
+    """
+    packet_struct = struct.Struct(struct_format)
+    packet = bytearray(packet_struct.pack(0xAA, 1, -2, 3, -4, 0))
+    packet[-1] = recv_feedback.calc_checksum(packet[:-1])
+    data = bytes(packet) * n
+
+    ser = _BufferSerial(data)
+    start = time.perf_counter()
+    for _ in range(n):
+        recv_feedback.receive_packet(struct_format, ser)
+    legacy_sec = time.perf_counter() - start
+
+    ser = _BufferSerial(data)
+    decoder = recv_feedback.FeedbackDecoder(struct_format)
+    decoded = 0
+    start = time.perf_counter()
+    while ser.in_waiting:
+        decoded += len(decoder.feed(ser.read(chunk)))
+    decoder_sec = time.perf_counter() - start
+
+    return {
+        "receive_packet_packets_per_sec": n / legacy_sec,
+        "decoder_packets_per_sec": decoded / decoder_sec,
+    }
+
+
+def bench_replay_parse(n=500000, packets_per_record=64):
+    """記録ファイルを最大速度で再生し、PacketParserの処理速度を計測する
+
+    Args:
+        n (int): パケット数
+        packets_per_record (int): 1回のreadで受信した想定のパケット数
+
+    Returns:
+        dict: 計測結果 [packets/s]
+    """
+    packet = bytearray(struct.pack("<BBBi", 0xAA, 8, 1, -1234))
+    packet.append(ah_uart.calc_checksum(packet))
+    record = bytes(packet) * packets_per_record
+
+    fd, path = tempfile.mkstemp(suffix=".bin")
+    os.close(fd)
+    try:
+        with ah_capture.CaptureWriter(path) as writer:
+            for i in range(n // packets_per_record):
+                writer.write(ah_capture.LINK_UART, record, timestamp=i * 1e-3)
+
+        ser = ah_capture.ReplaySerial(path)
+        parser = ah_uart.PacketParser()
+        parsed = 0
+        start = time.perf_counter()
+        while ser.in_waiting:
+            parsed += len(parser.read(ser))
+        elapsed = time.perf_counter() - start
+        ser.close()
+    finally:
+        os.remove(path)
+
+    return {
+        "packets": parsed,
+        "packet_parser_packets_per_sec": parsed / elapsed,
+    }
+
+
+def bench_udp_bulk(n_ticks=2000, n_boards=8, n_motors=4):
+    """loopbackでudp_send/udp_receiveとまとめ送受信の速度を比較する
+
+    Args:
+        n_ticks (int): 制御周期の回数
+        n_boards (int): esp32の台数
+        n_motors (int): 1台あたりのモータ数
+
+    Returns:
+        dict: 送信・受信のレートと1周期の送信時間
+    """
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+    receiver.bind(("127.0.0.1", 0))
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    board_ids = list(range(1, n_boards + 1))
+    for esp32_id in board_ids:
+        ah_python_ether.set_esp32_addr(esp32_id, receiver.getsockname())
+    commands = {
+        esp32_id: [(motor_id, 2, 1000) for motor_id in range(n_motors)]
+        for esp32_id in board_ids
+    }
+    n_entries = n_boards * n_motors
+    out = ah_python_ether.udp_receive_buffer(n_entries)
+
+    def drain():
+        while ah_python_ether.udp_receive_many(out, receiver):
+            pass
+
+    try:
+        # 送信
+        legacy_ticks = []
+        for _ in range(n_ticks):
+            start = time.perf_counter()
+            for esp32_id, entries in commands.items():
+                for motor_id, table_addr, data in entries:
+                    ah_python_ether.udp_send(esp32_id, motor_id, table_addr,
+                                             data, sender)
+            legacy_ticks.append(time.perf_counter() - start)
+            drain()
+
+        fanout_ticks = []
+        for _ in range(n_ticks):
+            start = time.perf_counter()
+            ah_python_ether.udp_send_fanout(commands, sender)
+            fanout_ticks.append(time.perf_counter() - start)
+            drain()
+
+        # 受信 (1周期分のフィードバックパケット)
+        legacy_sec = 0.0
+        many_sec = 0.0
+        received = 0
+        for i in range(n_ticks):
+            for esp32_id, entries in commands.items():
+                for entry in entries:
+                    ah_python_ether.udp_send(esp32_id, *entry, sender)
+            if i % 2 == 0:
+                start = time.perf_counter()
+                for _ in range(n_entries):
+                    ah_python_ether.udp_receive("<III", receiver)
+                legacy_sec += time.perf_counter() - start
+            else:
+                start = time.perf_counter()
+                got = 0
+                while got < n_entries:
+                    got += ah_python_ether.udp_receive_many(out[got:],
+                                                           receiver)
+                many_sec += time.perf_counter() - start
+                received += got
+    finally:
+        sender.close()
+        receiver.close()
+
+    n_half = n_ticks // 2
+    return {
+        "send_legacy_tick": _percentiles(legacy_ticks),
+        "send_fanout_tick": _percentiles(fanout_ticks),
+        "send_legacy_entries_per_sec": n_entries * n_ticks / sum(legacy_ticks),
+        "send_fanout_entries_per_sec": n_entries * n_ticks / sum(fanout_ticks),
+        "receive_legacy_packets_per_sec":
+            n_entries * (n_ticks - n_half) / legacy_sec,
+        "receive_many_packets_per_sec": received / many_sec,
+    }
+
+
+def bench_can_read_latency(n=2000, can_ids=CAN_IDS):
+    """read_pos/read_velの往復時間を計測する
+
+    Args:
+        n (int): 1関数あたりの試行回数
+        can_ids (tuple): 読み出すcan_id
+
+    Returns:
+        dict: 関数ごとの往復時間のパーセンタイルとタイムアウト数
+    """
+    channel = "ah_bench_can_read"
+    results = {}
+    with SimulatedCanMotor(channel, can_ids):
+        bus = can.Bus(interface="virtual", channel=channel)
+        try:
+            for name, read in (("read_pos", ah_python_can.read_pos),
+                               ("read_vel", ah_python_can.read_vel)):
+                samples = []
+                timeouts = 0
+                for i in range(n):
+                    can_id = can_ids[i % len(can_ids)]
+                    start = time.perf_counter()
+                    motor_id, _ = read(can_id, bus)
+                    elapsed = time.perf_counter() - start
+                    if motor_id is None:
+                        timeouts += 1
+                        # 遅れて届いた応答を次の計測に持ち越さない
+                        while bus.recv(timeout=0.005) is not None:
+                            pass
+                    else:
+                        samples.append(elapsed)
+                results[name] = dict(_percentiles(samples), timeouts=timeouts)
+        finally:
+            bus.shutdown()
+    return results
+
+
+def bench_can_read_state(n=1000, can_ids=CAN_IDS):
+    """read_stateで全モータの角度・速度を読む時間を、一括read対応/非対応のノードで比較する
+
+    Args:
+        n (int): 試行回数
+        can_ids (tuple): 読み出すcan_id
+
+    Returns:
+        dict: ノードごとの所要時間のパーセンタイルと欠損数
+    """
+    channel = "ah_bench_can_read_state"
+    results = {}
+    for name, read_multi in (("pipelined", False), ("combined", True)):
+        ah_python_can.reset_combined_read_support()
+        with SimulatedCanMotor(channel, can_ids, read_multi=read_multi):
+            bus = can.Bus(interface="virtual", channel=channel)
+            try:
+                samples = []
+                missing = 0
+                for _ in range(n):
+                    start = time.perf_counter()
+                    states = ah_python_can.read_state(can_ids, bus,
+                                                      timeout=0.01)
+                    samples.append(time.perf_counter() - start)
+                    missing += sum(
+                        state.pos is None or state.vel is None
+                        for state in states.values())
+            finally:
+                bus.shutdown()
+        results[name] = dict(_percentiles(samples), missing=missing)
+    ah_python_can.reset_combined_read_support()
+    return results
+
+
+def bench_can_setpoint_rate(duration=1.0, can_ids=CAN_IDS):
+    """set_goal_*を連続送信し、持続可能な送信レートとフレームあたりのCPU時間を計測する
+
+    Args:
+        duration (float): 計測時間 [s]
+        can_ids (tuple): 送信するcan_id
+
+    Returns:
+        dict: 関数ごとの送信レート・受信レート・CPU時間
+    """
+    channel = "ah_bench_can_setpoint"
+    results = {}
+    for name, set_goal in (("set_goal_pos", ah_python_can.set_goal_pos),
+                           ("set_goal_vel", ah_python_can.set_goal_vel),
+                           ("set_goal_pwm", ah_python_can.set_goal_pwm)):
+        with SimulatedCanMotor(channel, can_ids) as node:
+            bus = can.Bus(interface="virtual", channel=channel)
+            try:
+                sent = 0
+                start = time.perf_counter()
+                cpu_start = time.thread_time()
+                while time.perf_counter() - start < duration:
+                    for can_id in can_ids:
+                        set_goal(can_id, 0.5, bus)
+                    sent += len(can_ids)
+                cpu = time.thread_time() - cpu_start
+                elapsed = time.perf_counter() - start
+                # ノード側の受信が追いつくのを待つ
+                time.sleep(0.05)
+            finally:
+                bus.shutdown()
+        results[name] = {
+            "sent_frames_per_sec": sent / elapsed,
+            "received_frames_per_sec": node.received / elapsed,
+            "cpu_us_per_frame": cpu / sent * 1e6,
+        }
+    return results
+
+
+BENCHES = {
+    "can_send": bench_can_send,
+    "can_codec": bench_can_codec,
+    "can_read_latency": bench_can_read_latency,
+    "can_read_state": bench_can_read_state,
+    "can_setpoint_rate": bench_can_setpoint_rate,
+    "uart_packet": bench_uart_packet,
+    "feedback_decode": bench_feedback_decode,
+    "replay_parse": bench_replay_parse,
+    "udp_bulk": bench_udp_bulk,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("bench", nargs="*", help=", ".join(BENCHES))
+    parser.add_argument("-o", "--output", help="結果を保存するjsonファイル")
+    args = parser.parse_args()
+
+    names = args.bench or list(BENCHES)
+    for name in names:
+        if name not in BENCHES:
+            parser.error("unknown bench: " + name)
+
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "python-can": can.__version__,
+            "machine": platform.machine(),
+        },
+        "results": {name: BENCHES[name]() for name in names},
+    }
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+"""uart/canの受信バイト列を記録・再生するライブラリ
+記録したファイルをserial.Serialやcan_busの代わりに読ませることで、
+パーサの動作を実機なしで再現・計測できる
+
+ファイル構造
+  header : 8byte (b"AHCAP\\x00\\x01\\x00")
+  record : [timestamp : float64, link : uint8, length : uint16, data : length byte] * n
+
+canのdataは [arbitration_id : uint32, flags : uint8, frame data] で記録する
+"""
+
+import mmap
+import queue
+import struct
+import threading
+import time
+import can
+
+FILE_HEADER = b"AHCAP\x00\x01\x00"
+
+# link
+LINK_UART = 0
+LINK_FEEDBACK = 1
+LINK_CAN = 2
+
+_RECORD_HEADER = struct.Struct("<dBH")
+_CAN_HEADER = struct.Struct("<IB")
+
+# canのflags
+_CAN_EXTENDED = 0x01
+_CAN_REMOTE = 0x02
+_CAN_FD = 0x04
+
+
+def encode_can_frame(msg):
+    """can.Messageを記録用のバイト列にする
+
+    Args:
+        msg can.Message
+
+    Returns:
+        bytes
+    """
+    flags = ((_CAN_EXTENDED if msg.is_extended_id else 0) |
+             (_CAN_REMOTE if msg.is_remote_frame else 0) |
+             (_CAN_FD if msg.is_fd else 0))
+    return _CAN_HEADER.pack(msg.arbitration_id, flags) + bytes(msg.data)
+
+
+def decode_can_frame(data, timestamp=0.0):
+    """記録用のバイト列をcan.Messageに戻す
+
+    Args:
+        data (bytes): encode_can_frameの出力
+        timestamp (float): 受信時刻
+
+    Returns:
+        can.Message
+    """
+    arbitration_id, flags = _CAN_HEADER.unpack_from(data)
+    return can.Message(timestamp=timestamp,
+                       arbitration_id=arbitration_id,
+                       is_extended_id=bool(flags & _CAN_EXTENDED),
+                       is_remote_frame=bool(flags & _CAN_REMOTE),
+                       is_fd=bool(flags & _CAN_FD),
+                       data=data[_CAN_HEADER.size:])
+
+
+class CaptureWriter:
+    """受信データを追記専用のファイルに記録する
+    書き込みは別スレッドで行い、キューが一杯の場合は捨ててdroppedに数える
+
+    使い方:
+        with CaptureWriter("capture.bin") as writer:
+            ser = CapturingSerial(ser, writer)
+
+    Attributes:
+        path: 記録ファイル
+        dropped: キューが一杯で捨てたレコード数
+    """
+
+    def __init__(self, path, max_queue=10000):
+        self.path = path
+        self.dropped = 0
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._file = open(path, "wb")
+        self._file.write(FILE_HEADER)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, link, data, timestamp=None):
+        """レコードを追加する。ブロックしない
+
+        Args:
+            link (int): LINK_UART, LINK_FEEDBACK, LINK_CAN
+            data (bytes): 受信データ (65535byteまで)
+            timestamp (float): 受信時刻。Noneの場合time.time()
+        """
+        if not data:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        try:
+            self._queue.put_nowait(
+                _RECORD_HEADER.pack(timestamp, link, len(data)) + data)
+        except queue.Full:
+            self.dropped += 1
+
+    def write_can(self, msg):
+        """canフレームを記録する
+
+        Args:
+            msg can.Message
+        """
+        self.write(LINK_CAN, encode_can_frame(msg), msg.timestamp)
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            # 溜まっている分をまとめて書く
+            records = [record]
+            try:
+                while True:
+                    record = self._queue.get_nowait()
+                    if record is None:
+                        self._file.write(b"".join(records))
+                        return
+                    records.append(record)
+            except queue.Empty:
+                pass
+            self._file.write(b"".join(records))
+
+    def close(self):
+        """残りを書き出してファイルを閉じる"""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class CapturingSerial:
+    """serial.Serialを包み、readしたバイト列を記録する"""
+
+    def __init__(self, ser, writer, link=LINK_UART):
+        self.ser = ser
+        self.writer = writer
+        self.link = link
+
+    def read(self, size=1):
+        data = self.ser.read(size)
+        self.writer.write(self.link, data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+
+class CapturingBus:
+    """can_busを包み、recvしたフレームを記録する"""
+
+    def __init__(self, bus, writer):
+        self.bus = bus
+        self.writer = writer
+
+    def recv(self, timeout=None):
+        msg = self.bus.recv(timeout=timeout)
+        if msg is not None:
+            self.writer.write_can(msg)
+        return msg
+
+    def __getattr__(self, name):
+        return getattr(self.bus, name)
+
+
+class CaptureReader:
+    """記録ファイルをメモリマップして読む
+
+    Attributes:
+        records: (timestamp, link, offset, length) のリスト
+    """
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(FILE_HEADER)] != FILE_HEADER:
+            raise ValueError("not a capture file: " + str(path))
+
+        # レコードの位置を先に調べておく
+        self.records = []
+        pos = len(FILE_HEADER)
+        end = len(self._mmap)
+        while pos + _RECORD_HEADER.size <= end:
+            timestamp, link, length = _RECORD_HEADER.unpack_from(
+                self._mmap, pos)
+            pos += _RECORD_HEADER.size
+            if pos + length > end:
+                break  # 書き込み途中で終わったレコード
+            self.records.append((timestamp, link, pos, length))
+            pos += length
+
+    def read(self, offset, length):
+        """ファイルのoffsetからlength byteを返す"""
+        return self._mmap[offset:offset + length]
+
+    def iter_records(self, link=None):
+        """レコードを順に返す
+
+        Args:
+            link (int): 指定した場合そのlinkのみ
+
+        Returns:
+            Iterator[tuple]: (timestamp, link, bytes)
+        """
+        for timestamp, record_link, offset, length in self.records:
+            if link is None or record_link == link:
+                yield timestamp, record_link, self._mmap[offset:offset + length]
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+class _Pacer:
+    # 記録時刻の間隔で再生するための時計
+    def __init__(self, realtime):
+        self.realtime = realtime
+        self._offset = None
+
+    def wait(self, timestamp, timeout):
+        """timestampの再生時刻まで待つ。timeout内に来なければFalse"""
+        if not self.realtime:
+            return True
+        now = time.monotonic()
+        if self._offset is None:
+            self._offset = now - timestamp
+        delay = timestamp + self._offset - now
+        if delay <= 0:
+            return True
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            return False
+        time.sleep(delay)
+        return True
+
+
+class ReplaySerial:
+    """記録したuartの受信データを返すserial.Serialの代わり
+    realtime=Falseの場合は待たずに最大速度で返す
+
+    Args:
+        path: 記録ファイル
+        link: 再生するlink
+        realtime: 記録時の間隔で再生するか
+        timeout: readのタイムアウト [s] (realtime時のみ)
+    """
+
+    def __init__(self, path, link=LINK_UART, realtime=False, timeout=None):
+        self.timeout = timeout
+        self._reader = CaptureReader(path)
+        self._records = [(timestamp, offset, length)
+                         for timestamp, record_link, offset, length in
+                         self._reader.records if record_link == link]
+        self._pacer = _Pacer(realtime)
+        self._remaining = sum(length for _, _, length in self._records)
+        self._index = 0
+        self._pos = 0  # 現在のレコード内の位置
+
+    @property
+    def in_waiting(self):
+        if not self._pacer.realtime:
+            return self._remaining
+
+        # 再生時刻に達したバイト数
+        # スライスはリストをコピーするので添字で辿る
+        records = self._records
+        n = -self._pos
+        i = self._index
+        while i < len(records):
+            timestamp, _, length = records[i]
+            if not self._pacer.wait(timestamp, 0):
+                break
+            n += length
+            i += 1
+        return max(n, 0)
+
+    def read(self, size=1):
+        chunks = []
+        while size > 0 and self._index < len(self._records):
+            timestamp, offset, length = self._records[self._index]
+            if not self._pacer.wait(timestamp, self.timeout):
+                break
+            n = min(size, length - self._pos)
+            chunks.append(self._reader.read(offset + self._pos, n))
+            size -= n
+            self._pos += n
+            self._remaining -= n
+            if self._pos == length:
+                self._index += 1
+                self._pos = 0
+        return b"".join(chunks)
+
+    def write(self, data):
+        return len(data)
+
+    def reset_input_buffer(self):
+        pass
+
+    def close(self):
+        self._reader.close()
+
+
+class ReplayBus:
+    """記録したcanフレームを返すcan_busの代わり。送信は捨てる
+
+    Args:
+        path: 記録ファイル
+        realtime: 記録時の間隔で再生するか
+    """
+
+    def __init__(self, path, realtime=False):
+        self._reader = CaptureReader(path)
+        self._records = self._reader.iter_records(LINK_CAN)
+        self._pacer = _Pacer(realtime)
+        self._next = None
+
+    def recv(self, timeout=None):
+        if self._next is None:
+            self._next = next(self._records, None)
+            if self._next is None:
+                return None
+        timestamp, _, data = self._next
+        if not self._pacer.wait(timestamp, timeout):
+            return None
+        self._next = None
+        return decode_can_frame(data, timestamp)
+
+    def send(self, msg, timeout=None):
+        pass
+
+    def set_filters(self, filters=None):
+        pass
+
+    def shutdown(self):
+        self._records.close()
+        self._reader.close()
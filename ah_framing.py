@@ -0,0 +1,134 @@
+"""uartパケットの組み立てとチェックサム
+ah_uart, recv_feedbackで共通に使う
+
+パケット構造
+  header : 1byte (0xAA)
+  packet_length : 1byte
+  motor_id : 1byte
+  table_addr : 1byte
+  data : 1byte or 4byte (リトルエンディアン)
+  checksum : 1byte (全バイトの排他的論理和が0になる値)
+"""
+
+import struct
+import numpy as np
+
+HEADER = 0xAA
+
+# チェックサムまで含めて1回のpack_intoで書き込む
+_PACKET_1BYTE = struct.Struct("<BBBBBB")
+_PACKET_4BYTE = struct.Struct("<BBBBiB")
+_PACKET_4VALUE = struct.Struct("<BBBB4iB")
+_READ_INSTRUCTION = struct.Struct("<BBBBB")
+
+
+def xor_int32(value):
+    """int32の4byteの排他的論理和を計算する
+
+    Args:
+        value (int32): 値
+
+    Returns:
+        4byteの排他的論理和
+    """
+    value &= 0xFFFFFFFF
+    value ^= value >> 16
+    value ^= value >> 8
+    return value & 0xFF
+
+
+def calc_checksum(packet_data):
+    """排他的論理和チェックサムを計算する
+    短いパケットはそのまま、長いバッファはint/numpyでまとめて計算する
+
+    Args:
+        packet_data (bytes | bytearray | memoryview | list[int]): パケットデータ
+
+    Returns:
+        チェックサム値
+    """
+    n = len(packet_data)
+    if n < 64 or isinstance(packet_data, list):
+        checksum_val = 0
+        for value in packet_data:
+            checksum_val ^= value
+        return checksum_val
+
+    if n < 256:
+        # 上位半分と下位半分のxorを1byteになるまで繰り返す
+        value = int.from_bytes(packet_data, "little")
+        bits = n * 8
+        while bits > 8:
+            bits = (bits + 15) // 16 * 8
+            value = (value >> bits) ^ (value & ((1 << bits) - 1))
+        return value
+
+    return int(np.bitwise_xor.reduce(np.frombuffer(packet_data, np.uint8)))
+
+
+class PacketBuilder:
+    """送信パケットを使い回しのbytearrayに組み立てる
+    チェックサムはヘッダと値のxorから直接求め、パケット全体を1回のpack_intoで書き込む。
+    返り値のmemoryviewは次の組み立てで上書きされるので、すぐにwriteすること。
+    スレッドごとに別のインスタンスを使うこと
+    """
+
+    def __init__(self):
+        self._buf = bytearray(32)
+        view = memoryview(self._buf)
+        self._view_5 = view[:5]
+        self._view_6 = view[:6]
+        self._view_9 = view[:9]
+        self._view_21 = view[:21]
+
+    def packet_1byte(self, motor_id, table_addr, data):
+        """1byte送信パケット
+
+        Returns:
+            memoryview: パケット
+        """
+        _PACKET_1BYTE.pack_into(self._buf, 0, HEADER, 6, motor_id, table_addr,
+                                data, HEADER ^ 6 ^ motor_id ^ table_addr ^ data)
+        return self._view_6
+
+    def packet_4byte(self, motor_id, table_addr, data_int):
+        """4byte送信パケット
+
+        Args:
+            data_int (int32): 送信値 (1000倍済み)
+
+        Returns:
+            memoryview: パケット
+        """
+        _PACKET_4BYTE.pack_into(
+            self._buf, 0, HEADER, 9, motor_id, table_addr, data_int,
+            HEADER ^ 9 ^ motor_id ^ table_addr ^ xor_int32(data_int))
+        return self._view_9
+
+    def packet_4value(self, motor_id, table_addr, data_1, data_2, data_3,
+                      data_4):
+        """4つの値をまとめた送信パケット
+
+        Args:
+            data_1-4 (int32): 送信値 (1000倍済み)
+
+        Returns:
+            memoryview: パケット
+        """
+        checksum_val = HEADER ^ 21 ^ motor_id ^ table_addr ^ xor_int32(
+            data_1 ^ data_2 ^ data_3 ^ data_4)
+        _PACKET_4VALUE.pack_into(self._buf, 0, HEADER, 21, motor_id,
+                                 table_addr, data_1, data_2, data_3, data_4,
+                                 checksum_val)
+        return self._view_21
+
+    def read_instruction(self, motor_id, table_addr):
+        """read命令パケット
+
+        Returns:
+            memoryview: パケット
+        """
+        _READ_INSTRUCTION.pack_into(self._buf, 0, HEADER, 5, motor_id,
+                                    table_addr,
+                                    HEADER ^ 5 ^ motor_id ^ table_addr)
+        return self._view_5
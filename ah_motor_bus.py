@@ -0,0 +1,361 @@
+"""通信方式によらないモータ操作のインタフェース
+can, uart, udp, dynamixelを同じ呼び出し方で操作し、各方式のまとめ送受信を使う
+
+値と制御モードは全ての方式で共通
+  値   : ah_python_can/ah_uartのset_goal_*と同じ単位の実数 (通信時に1000倍)。
+         dynamixelは既定で角度 [rad]、速度 [rad/s]、pwm [-1, 1] として変換する
+  モード: MODE_* (マイコンのモード番号)。dynamixelは対応するモードに変換する
+
+使い方:
+    motor_bus = CanMotorBus(bus)  # UartMotorBus(ser), UdpMotorBus(esp32_id, sock) ...
+    motor_bus.set_goal_vel({0x100: 1.0, 0x101: -1.0})
+    positions = motor_bus.read_pos([0x100, 0x101])
+"""
+
+import abc
+import math
+import weakref
+
+from . import ah_python_can
+from . import ah_python_ether
+from . import ah_uart
+
+# マイコンのコントロールテーブルアドレス
+OPERATING_MODE_ADDR = 0
+GOAL_POS_ADDR = 1
+GOAL_VEL_ADDR = 2
+GOAL_PWM_ADDR = 3
+CURRENT_POS_ADDR = 4
+CURRENT_SPEED_ADDR = 5
+
+# 制御モード (マイコンのモード番号)
+MODE_STOP = 0
+MODE_ENC_POS = 1
+MODE_POTENTIO_POS = 2
+MODE_VEL = 3
+MODE_PWM = 4
+MODE_AIR = 5
+
+
+class MotorBus(abc.ABC):
+    """モータ通信の共通インタフェース
+    motorは各方式でのモータの指定 (can_id, motor_id, dxl_id)。
+    各方式はwrite_many, read_many, set_modeを実装する
+    (実装していない場合はインスタンス作成時にTypeErrorになる)
+    """
+
+    @abc.abstractmethod
+    def write_many(self, table_addr, values):
+        """複数モータへ書き込む
+
+        Args:
+            table_addr コントロールテーブルアドレス
+            values (dict): {motor: value} 共通の単位の実数
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def read_many(self, motors, table_addr):
+        """複数モータから読み出す
+
+        Args:
+            motors (Iterable): motorのリスト
+            table_addr コントロールテーブルアドレス
+
+        Returns:
+            dict: {motor: value} 読めなかったモータはNone
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_mode(self, modes):
+        """制御モードを設定する
+
+        Args:
+            modes (dict): {motor: MODE_*}
+        """
+        raise NotImplementedError
+
+    def write(self, motor, table_addr, value):
+        self.write_many(table_addr, {motor: value})
+
+    def read(self, motor, table_addr):
+        return self.read_many([motor], table_addr)[motor]
+
+    def set_goal_pos(self, goals):
+        self.write_many(GOAL_POS_ADDR, goals)
+
+    def set_goal_vel(self, goals):
+        self.write_many(GOAL_VEL_ADDR, goals)
+
+    def set_goal_pwm(self, goals):
+        self.write_many(GOAL_PWM_ADDR, goals)
+
+    def read_pos(self, motors):
+        return self.read_many(motors, CURRENT_POS_ADDR)
+
+    def read_vel(self, motors):
+        return self.read_many(motors, CURRENT_SPEED_ADDR)
+
+    def read_pos_vel(self, motors):
+        """角度と速度を読み出す
+
+        Returns:
+            dict: {motor: (pos, vel)} 読めなかった値はNone
+        """
+        motors = list(motors)
+        positions = self.read_pos(motors)
+        velocities = self.read_vel(motors)
+        return {
+            motor: (positions[motor], velocities[motor]) for motor in motors
+        }
+
+
+class CanMotorBus(MotorBus):
+    """ah_python_canによる実装
+
+    Args:
+        bus: can_bus
+        timeout: 読み出しの応答待ち時間 [s]
+    """
+
+    def __init__(self, bus, timeout=0.002):
+        self.bus = bus
+        self.timeout = timeout
+
+    def write_many(self, table_addr, values):
+        ah_python_can.send_packet_4byte_many(table_addr, values, self.bus)
+
+    def read_many(self, motors, table_addr):
+        states = ah_python_can.read_state(motors, self.bus, (table_addr,),
+                                          self.timeout)
+        return {
+            can_id: state.values.get(table_addr)
+            for can_id, state in states.items()
+        }
+
+    def read_pos_vel(self, motors):
+        # 角度と速度を一括read命令でまとめて読む
+        states = ah_python_can.read_state(motors, self.bus,
+                                          (CURRENT_POS_ADDR,
+                                           CURRENT_SPEED_ADDR), self.timeout)
+        return {
+            can_id: (state.pos, state.vel) for can_id, state in states.items()
+        }
+
+    def set_mode(self, modes):
+        for can_id, mode in modes.items():
+            if mode == MODE_STOP:
+                # 周期送信も止める
+                ah_python_can.set_stop_mode(can_id, self.bus)
+            else:
+                ah_python_can.send_packet_1byte(can_id, OPERATING_MODE_ADDR,
+                                                mode, self.bus)
+
+
+class UartMotorBus(MotorBus):
+    """ah_uartによる実装。sync_write/sync_readで1回の通信にまとめる
+
+    Args:
+        ser: シリアルインスタンス
+        timeout: 読み出しの応答待ち時間 [s]
+    """
+
+    def __init__(self, ser, timeout=0.01):
+        self.ser = ser
+        self.timeout = timeout
+        self.parser = ah_uart.PacketParser()
+
+    def write_many(self, table_addr, values):
+        ah_uart.sync_write([(motor_id, table_addr, value)
+                            for motor_id, value in values.items()], self.ser)
+
+    def read_many(self, motors, table_addr):
+        motors = list(motors)
+        result = ah_uart.sync_read([(motor_id, table_addr)
+                                    for motor_id in motors], self.ser,
+                                   self.parser, self.timeout)
+        return {
+            motor_id: result.get((motor_id, table_addr)) for motor_id in motors
+        }
+
+    def set_mode(self, modes):
+        for motor_id, mode in modes.items():
+            ah_uart.send_packet_1byte(motor_id, OPERATING_MODE_ADDR, mode,
+                                      self.ser)
+
+
+class UdpMotorBus(MotorBus):
+    """ah_python_etherによる実装。1台のesp32のモータを操作する
+    値はcan/uartと同じくscale倍したint32を"<III"のビット列で送り、受信値はscaleで割る。
+    udpにはread命令がないため、read_manyはesp32が送ってくる
+    "<III" (motor_id, table_addr, data) のパケットの最新値を返す。
+    同じソケットを複数のesp32で共有する場合、受信したパケットは送信元ipごとに
+    ソケット単位の表に振り分けるため、他のesp32のインスタンスが読んだ分も失われない
+
+    Args:
+        esp32_id: ipアドレスの最下位
+        sock: udpソケット
+        max_packets: 1回に受信する最大パケット数
+        scale: 送信値の倍率 (esp32側で割る値。生の値を送る場合は1)
+    """
+
+    # sock -> {送信元ip: {(motor_id, table_addr): value}}
+    _latest_by_socket = weakref.WeakKeyDictionary()
+
+    def __init__(self, esp32_id, sock, max_packets=256, scale=1000):
+        self.esp32_id = esp32_id
+        self.sock = sock
+        self.scale = scale
+        self.ip = ah_python_ether.esp32_addr(esp32_id)[0]
+
+        # (motor_id, table_addr) -> value (このesp32から受信したもの)
+        self._by_ip = UdpMotorBus._latest_by_socket.setdefault(sock, {})
+        self.latest = self._by_ip.setdefault(self.ip, {})
+
+        self._buffer = ah_python_ether.udp_receive_buffer(max_packets)
+        self._senders = []
+
+    def write_many(self, table_addr, values):
+        # 負の値は2の補数のuint32にする (esp32側はint32として読む)
+        ah_python_ether.udp_send_many(
+            self.esp32_id,
+            [(motor_id, table_addr, int(round(value * self.scale)) & 0xFFFFFFFF)
+             for motor_id, value in values.items()], self.sock)
+
+    def poll(self):
+        """受信キューにあるパケットを全て読み、送信元ごとに最新値を更新する"""
+        while True:
+            n = ah_python_ether.udp_receive_many(self._buffer, self.sock,
+                                                 self._senders)
+            for (motor_id, table_addr, data), addr in zip(
+                    self._buffer[:n].tolist(), self._senders):
+                latest = self._by_ip.get(addr[0])
+                if latest is None:
+                    latest = self._by_ip.setdefault(addr[0], {})
+                latest[(motor_id, table_addr)] = data
+            if n < len(self._buffer):
+                break
+
+    def read_many(self, motors, table_addr):
+        self.poll()
+        result = {}
+        for motor_id in motors:
+            data = self.latest.get((motor_id, table_addr))
+            if data is not None:
+                if data > 0x7FFFFFFF:
+                    data -= 0x100000000
+                data /= self.scale
+            result[motor_id] = data
+        return result
+
+    def set_mode(self, modes):
+        # モード番号は倍率をかけずに送る
+        ah_python_ether.udp_send_many(
+            self.esp32_id, [(motor_id, OPERATING_MODE_ADDR, mode)
+                            for motor_id, mode in modes.items()], self.sock)
+
+
+# MODE_* -> dynamixelのOperating Mode
+DYNAMIXEL_MODES = {
+    MODE_ENC_POS: 4,  # 拡張位置制御 (起動時の位置からの相対角度)
+    MODE_POTENTIO_POS: 3,  # 位置制御 (絶対角度)
+    MODE_VEL: 1,
+    MODE_PWM: 16,
+}
+
+# dynamixel (X series) の既定の倍率 共通の単位 -> dynamixelの値
+DYNAMIXEL_SCALES = {
+    GOAL_POS_ADDR: 4096 / (2 * math.pi),  # rad -> 0.088 [deg]
+    GOAL_VEL_ADDR: 60 / (2 * math.pi * 0.229),  # rad/s -> 0.229 [rpm]
+    GOAL_PWM_ADDR: 885,  # [-1, 1] -> 0.113 [%]
+}
+
+
+class DynamixelMotorBus(MotorBus):
+    """dyna_lib.dxl_controllerによる実装
+    角度・速度はGroupSyncWriteでまとめて書き込み、GroupSyncReadでまとめて読む。
+    サーボが複数のdxl_busにつながっている場合はバスごとにまとめる。
+    値はscales倍してdynamixelの値にし、読んだ値はscalesで割る。
+    拡張位置制御のサーボの角度は起動時の位置からの相対角度になる
+
+    Args:
+        controllers (dict): {dxl_id: dxl_controller}
+        scales (dict): {GOAL_POS_ADDR / GOAL_VEL_ADDR / GOAL_PWM_ADDR: 倍率}
+                       指定しないものはDYNAMIXEL_SCALES
+    """
+
+    def __init__(self, controllers, scales=None):
+        self.controllers = dict(controllers)
+        self.scales = dict(DYNAMIXEL_SCALES)
+        self.scales.update(scales or {})
+
+    def _group_by_bus(self, dxl_ids):
+        # dxl_bus -> [dxl_id, ...]
+        groups = {}
+        for dxl_id in dxl_ids:
+            groups.setdefault(self.controllers[dxl_id].bus, []).append(dxl_id)
+        return groups
+
+    def write_many(self, table_addr, values):
+        if not values:
+            return
+        if table_addr not in self.scales:
+            raise ValueError("unsupported table_addr: %d" % table_addr)
+        scale = self.scales[table_addr]
+        if table_addr == GOAL_POS_ADDR:
+            for bus, dxl_ids in self._group_by_bus(values).items():
+                bus.sync_write_pos(
+                    {dxl_id: values[dxl_id] * scale for dxl_id in dxl_ids})
+        elif table_addr == GOAL_VEL_ADDR:
+            for bus, dxl_ids in self._group_by_bus(values).items():
+                bus.sync_write_vel(
+                    {dxl_id: values[dxl_id] * scale for dxl_id in dxl_ids})
+        else:
+            for dxl_id, goal in values.items():
+                self.controllers[dxl_id].write_goal_pwm(
+                    int(round(goal * scale)))
+
+    def read_many(self, motors, table_addr):
+        if table_addr == CURRENT_POS_ADDR:
+            column = 0
+        elif table_addr == CURRENT_SPEED_ADDR:
+            column = 1
+        else:
+            raise ValueError("unsupported table_addr: %d" % table_addr)
+        return {
+            dxl_id: pos_vel[column]
+            for dxl_id, pos_vel in self.read_pos_vel(motors).items()
+        }
+
+    def read_pos_vel(self, motors):
+        pos_scale = self.scales[GOAL_POS_ADDR]
+        vel_scale = self.scales[GOAL_VEL_ADDR]
+        result = {}
+        for bus, dxl_ids in self._group_by_bus(motors).items():
+            state, valid, _ = bus.read_group_state(dxl_ids)
+            for dxl_id, (pos, vel), ok in zip(dxl_ids, state, valid):
+                if not ok:
+                    result[dxl_id] = (None, None)
+                    continue
+                controller = self.controllers[dxl_id]
+                pos = int(pos)
+                # 書き込み時に足した起動時の位置を引く
+                if controller.mode == 4:
+                    pos -= controller.initialize_pos
+                result[dxl_id] = (pos / pos_scale, int(vel) / vel_scale)
+        return result
+
+    def set_mode(self, modes):
+        for dxl_id, mode in modes.items():
+            if mode != MODE_STOP and mode not in DYNAMIXEL_MODES:
+                raise ValueError("unsupported mode: %d" % mode)
+
+        for dxl_id, mode in modes.items():
+            controller = self.controllers[dxl_id]
+            controller.set_torque(0)
+            if mode == MODE_STOP:
+                continue
+            controller.mode = DYNAMIXEL_MODES[mode]
+            controller.set_mode()
+            controller.set_torque(1)
@@ -4,9 +4,11 @@
 
 import asyncio
 import can
+import threading
 import time
 import numpy as np
 import struct
+from collections import deque, namedtuple
 
 #
 #  OPERATING_MODE_ADDR = 0,
@@ -32,6 +34,65 @@ import struct
 #  air_mode = 5,
 #
 
+# 複数アドレス一括read命令 [0x80, addr1, addr2, ...]
+# 応答はcan_id + 4で、dlc 8のフレームに要求順の値を2つずつ(端数はdlc 4)詰めて返す
+READ_MULTI_TABLE_ADDR = 0x80
+
+# 一括read命令に連続でCOMBINED_READ_MAX_MISSES回応答しなかったcan_id。以降は個別read命令で読む
+combined_read_unsupported = set()
+COMBINED_READ_MAX_MISSES = 3
+_combined_read_misses = {}  # can_id -> 連続で応答しなかった回数
+
+# read_stateでタイムアウトしたcan_idは、遅れた応答が届き終わるまで
+# READ_QUIET_PERIOD [s] 次のread命令を送らない
+READ_QUIET_PERIOD = 0.005
+_read_quiet_until = {}  # can_id -> 次のread命令を送れる時刻
+
+# フレームのエンコード/デコード用
+_FRAME_1BYTE = struct.Struct("<BB")  # table_addr, data
+_FRAME_4BYTE = struct.Struct("<Bi")  # table_addr, int32 (リトルエンディアン)
+_INT32 = struct.Struct("<i")
+
+# 送信用can.Messageの使い回し (スレッドごと)
+_msg_pool = threading.local()
+
+
+def _pooled_message(can_id, dlc):
+    """送信用のcan.Messageを取得する
+    (can_id, dlc)ごとに1つ確保し、dataをpack_intoで書き換えて使い回す。
+    bus.sendはその場でフレームを書き出すため再利用できるが、
+    send_periodicのようにメッセージを保持する用途には使わないこと
+
+    Args:
+        can_id
+        dlc データ長
+
+    Returns: can.Message
+    """
+    try:
+        pool = _msg_pool.msgs
+    except AttributeError:
+        pool = _msg_pool.msgs = {}
+
+    msg = pool.get((can_id, dlc))
+    if msg is None:
+        msg = can.Message(arbitration_id=can_id,
+                          data=bytearray(dlc),
+                          is_extended_id=False)
+        pool[(can_id, dlc)] = msg
+    return msg
+
+
+# send_periodicで周期送信中のタスク
+# (id(bus), can_id) -> {table_addr: (task, payload)}
+_periodic_tasks = {}
+_periodic_lock = threading.Lock()
+
+# 受信フレームの統計
+#   delivered : デコードしたフィードバックフレーム数
+#   rejected  : python側で捨てたフレーム数 (カーネルフィルタで捨てた分は含まない)
+frame_stats = {"delivered": 0, "rejected": 0}
+
 
 def send_packet_1byte(can_id, table_addr, data, bus):
     """1byte送信
@@ -43,8 +104,8 @@ def send_packet_1byte(can_id, table_addr, data, bus):
         data 1byte
         bus can_bus
     """
-    packet = [table_addr, data]
-    msg = can.Message(arbitration_id=can_id, data=packet, is_extended_id=False)
+    msg = _pooled_message(can_id, 2)
+    _FRAME_1BYTE.pack_into(msg.data, 0, table_addr, data)
     bus.send(msg)
 
 
@@ -59,14 +120,81 @@ def send_packet_4byte(can_id, table_addr, data, bus):
         bus can_bus
     """
 
-    data_int = int(data * 1000)
-    byte1, byte2, byte3, byte4 = from_int32_to_bytes(data_int)
-    packet = [table_addr, byte1, byte2, byte3, byte4]  #リトルエンディアン
-
-    msg = can.Message(arbitration_id=can_id, data=packet, is_extended_id=False)
+    msg = _pooled_message(can_id, 5)
+    _FRAME_4BYTE.pack_into(msg.data, 0, table_addr, int(data * 1000))
     bus.send(msg)
 
 
+def send_packet_4byte_many(table_addr, goals, bus):
+    """複数モータへの4byte送信をまとめて行う
+    1000をかけて送信する、受信先で1000で割る
+    フレームを先に全て組み立ててから連続で送信する
+
+    Args:
+        table_addr コントロールテーブルアドレス
+        goals dict {can_id: data}
+        bus can_bus
+    """
+    msgs = []
+    for can_id, data in goals.items():
+        msg = _pooled_message(can_id, 5)
+        _FRAME_4BYTE.pack_into(msg.data, 0, table_addr, int(data * 1000))
+        msgs.append(msg)
+    for msg in msgs:
+        bus.send(msg)
+
+
+def stream_packet_4byte(can_id, table_addr, data, bus, period):
+    """4byteのフレームをsend_periodicで周期送信する
+    1000をかけて送信する、受信先で1000で割る
+    送信中のフレームはmodify_dataで書き換え、値が変わらなければ何もしない。
+    SocketCANではカーネル(broadcast manager)が送信するため、周期ごとのpython処理はない
+
+    Args:
+        can_id
+        table_addr コントロールテーブルアドレス
+        data 4byte
+        bus can_bus
+        period 送信周期 [s]
+    """
+    payload = _FRAME_4BYTE.pack(table_addr, int(data * 1000))
+
+    with _periodic_lock:
+        tasks = _periodic_tasks.setdefault((id(bus), can_id), {})
+        entry = tasks.get(table_addr)
+
+        if entry is not None and entry[0].period == period:
+            task, last_payload = entry
+            if payload == last_payload:
+                return
+            task.modify_data(
+                can.Message(arbitration_id=can_id,
+                            data=payload,
+                            is_extended_id=False))
+        else:
+            # 周期が変わった場合は作り直す
+            if entry is not None:
+                entry[0].stop()
+            task = bus.send_periodic(
+                can.Message(arbitration_id=can_id,
+                            data=payload,
+                            is_extended_id=False), period)
+        tasks[table_addr] = (task, payload)
+
+
+def stop_stream(can_id, bus):
+    """can_idの周期送信を全て停止する
+
+    Args:
+        can_id
+        bus can_bus
+    """
+    with _periodic_lock:
+        tasks = _periodic_tasks.pop((id(bus), can_id), {})
+    for task, _ in tasks.values():
+        task.stop()
+
+
 def from_int32_to_bytes(data):
     """リトルエンディアンでint32をバイト列に変換し、tupleで返す
 
@@ -84,34 +212,76 @@ def from_int32_to_bytes(data):
     return (byte1, byte2, byte3, byte4)
 
 
-def receive_frame(period, bus):
-    recv_msg = bus.recv(timeout=period)
+def decode_frame(recv_msg):
+    """受信フレームをデコードする
 
-    if recv_msg is None:
-        return None, None
+    Args:
+        recv_msg can.Message
 
+    Returns: (can_id, int32) 対象外のフレームは (None, None)
+    """
     motor_id = (recv_msg.arbitration_id & 0x00F) - 4
     #print(motor_id)
 
-    if motor_id < 0 or motor_id > 3:
+    # int32に満たないフレームも対象外
+    if motor_id < 0 or motor_id > 3 or recv_msg.dlc < 4:
+        frame_stats["rejected"] += 1
         return None, None
 
-    recv_data = ((recv_msg.data[3] << 24) | (recv_msg.data[2] << 16) |
-                 (recv_msg.data[1] << 8) | (recv_msg.data[0]))
+    recv_data = _INT32.unpack_from(recv_msg.data)[0]
+    frame_stats["delivered"] += 1
 
-    if (recv_data is None):
-        return None, None
+    return recv_msg.arbitration_id - 4, recv_data
 
-    recv_data = struct.pack("<I", recv_data)
-    recv_data = struct.unpack("<i", recv_data)[0]
 
-    return recv_msg.arbitration_id - 4, recv_data
+def feedback_filters(can_ids):
+    """can_idのフィードバックフレーム(arbitration_id = can_id + 4)だけを通すcan_filtersを作る
+
+    Args:
+        can_ids Iterable[can_id]
+
+    Returns: list[dict] python-canのcan_filters
+    """
+    return [{
+        "can_id": can_id + 4,
+        "can_mask": 0x7FF,
+        "extended": False
+    } for can_id in sorted(set(can_ids))]
+
+
+def set_feedback_filters(can_ids, bus):
+    """登録したモータのフィードバック以外を受信しないようにフィルタを設定する
+    SocketCANではカーネルで捨てられ、pythonまで届かない
+
+    Args:
+        can_ids Iterable[can_id]
+        bus can_bus
+    """
+    bus.set_filters(feedback_filters(can_ids))
+
+
+def reset_frame_stats():
+    """受信フレームの統計を0に戻す"""
+    for key in frame_stats:
+        frame_stats[key] = 0
+
+
+def receive_frame(period, bus):
+    recv_msg = bus.recv(timeout=period)
+
+    if recv_msg is None:
+        return None, None
+
+    return decode_frame(recv_msg)
 
 
 def set_stop_mode(can_id, bus):
     table_addr = 0
     data = 0
 
+    # 周期送信中の目標値で再び動き出さないよう先に止める
+    stop_stream(can_id, bus)
+
     send_packet_1byte(can_id, table_addr, data, bus)
 
 
@@ -165,6 +335,57 @@ def set_goal_pwm(can_id, data, bus):
     send_packet_4byte(can_id, table_addr, data, bus)
 
 
+def set_goal_pos_many(goals, bus):
+    """複数モータの目標角度をまとめて送信する
+
+    Args:
+        goals dict {can_id: goal_pos}
+        bus can_bus
+    """
+    table_addr = 1
+    send_packet_4byte_many(table_addr, goals, bus)
+
+
+def set_goal_vel_many(goals, bus):
+    """複数モータの目標速度をまとめて送信する
+
+    Args:
+        goals dict {can_id: goal_vel}
+        bus can_bus
+    """
+    table_addr = 2
+    send_packet_4byte_many(table_addr, goals, bus)
+
+
+def set_goal_pwm_many(goals, bus):
+    """複数モータの目標pwmをまとめて送信する
+
+    Args:
+        goals dict {can_id: goal_pwm}
+        bus can_bus
+    """
+    table_addr = 3
+    send_packet_4byte_many(table_addr, goals, bus)
+
+
+def stream_goal_pos(can_id, data, bus, period=0.01):
+    """目標角度を周期送信する。set_stop_modeで停止する"""
+    table_addr = 1
+    stream_packet_4byte(can_id, table_addr, data, bus, period)
+
+
+def stream_goal_vel(can_id, data, bus, period=0.01):
+    """目標速度を周期送信する。set_stop_modeで停止する"""
+    table_addr = 2
+    stream_packet_4byte(can_id, table_addr, data, bus, period)
+
+
+def stream_goal_pwm(can_id, data, bus, period=0.01):
+    """目標pwmを周期送信する。set_stop_modeで停止する"""
+    table_addr = 3
+    stream_packet_4byte(can_id, table_addr, data, bus, period)
+
+
 def set_air(can_id, data, bus):
     table_addr = 12
     send_packet_1byte(can_id, table_addr, data, bus)
@@ -197,30 +418,184 @@ def set_vel_pid_gain(can_id, p_gain, i_gain, d_gain, bus):
     send_packet_4byte(can_id, 11, d_gain, bus)  #d_gain
 
 
+def send_read_instruction(can_id, table_addr, bus):
+    """read命令を送信する
+
+    Args:
+        can_id
+        table_addr コントロールテーブルアドレス
+        bus can_bus
+    """
+    msg = _pooled_message(can_id, 1)
+    msg.data[0] = table_addr
+    bus.send(msg)
+
+
 def send_read_pos_instruction(can_id, bus):
     """角度　read命令を送信する"""
 
     current_pos_table_addr = 4
-
-    packet = [current_pos_table_addr]
-    msg = can.Message(arbitration_id=can_id, data=packet, is_extended_id=False)
-    bus.send(msg)
+    send_read_instruction(can_id, current_pos_table_addr, bus)
 
 
 def send_read_vel_instruction(can_id, bus):
     """速度　read命令を送信する"""
 
     current_vel_table_addr = 5
+    send_read_instruction(can_id, current_vel_table_addr, bus)
+
+
+class MotorState(namedtuple("MotorState", ["can_id", "values", "timestamp"])):
+    """read_stateの結果
+
+    Attributes:
+        can_id
+        values: dict {table_addr: value} 応答がなかったアドレスは含まない
+        timestamp: 最後に受信したフレームの時刻 未受信の場合None
+    """
 
-    packet = [current_vel_table_addr]
+    __slots__ = ()
+
+    @property
+    def pos(self):
+        return self.values.get(4)
+
+    @property
+    def vel(self):
+        return self.values.get(5)
+
+
+def send_read_multi_instruction(can_id, table_addrs, bus):
+    """複数アドレスの一括read命令を送信する
+
+    Args:
+        can_id
+        table_addrs コントロールテーブルアドレスのリスト (7個まで)
+        bus can_bus
+    """
+    packet = [READ_MULTI_TABLE_ADDR] + list(table_addrs)
     msg = can.Message(arbitration_id=can_id, data=packet, is_extended_id=False)
     bus.send(msg)
 
 
+def reset_combined_read_support():
+    """一括read命令の未対応判定を消し、全モータで一括read命令を試し直す"""
+    combined_read_unsupported.clear()
+    _combined_read_misses.clear()
+
+
+def read_state(can_ids, bus, table_addrs=(4, 5), timeout=0.002,
+               combined_read=True):
+    """複数モータの複数アドレスをまとめて読み出す
+    一括read命令で1フレームに詰めて返してもらい、応答しないモータ(一括read未対応の
+    ファームウェア)は、個別read命令を全モータ分連続で送ってから応答を集める
+
+    応答にはテーブルアドレスがないため、送信前に受信キューに残っているフレームを捨て、
+    前回タイムアウトしたモータにはREAD_QUIET_PERIODが過ぎるまで送信しない
+
+    Args:
+        can_ids Iterable[can_id]
+        bus can_bus
+        table_addrs コントロールテーブルアドレスのリスト
+        timeout 全応答を待つ時間 [s]
+        combined_read Falseの場合は一括read命令を使わない
+
+    Returns: dict {can_id: MotorState}
+    """
+    can_ids = list(can_ids)
+    table_addrs = tuple(table_addrs)
+
+    combined = []
+    if combined_read and len(table_addrs) > 1:
+        combined = [
+            can_id for can_id in can_ids
+            if can_id not in combined_read_unsupported
+        ]
+
+    combined_set = set(combined)
+
+    # 前回タイムアウトしたモータの遅れた応答が届き終わるまで待ってから、
+    # 届いていたフレームを全て捨てる
+    quiet_until = max(
+        (_read_quiet_until.pop(can_id, 0.0) for can_id in can_ids),
+        default=0.0)
+    delay = quiet_until - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+    while bus.recv(timeout=0) is not None:
+        pass
+
+    # 応答待ちのアドレス (要求順)
+    pending = {can_id: deque(table_addrs) for can_id in can_ids}
+    for can_id in can_ids:
+        if can_id in combined:
+            send_read_multi_instruction(can_id, table_addrs, bus)
+        else:
+            for table_addr in table_addrs:
+                send_read_instruction(can_id, table_addr, bus)
+
+    values = {can_id: {} for can_id in can_ids}
+    timestamps = {}
+    remaining = len(can_ids) * len(table_addrs)
+    deadline = time.monotonic() + timeout
+    while remaining > 0:
+        wait = deadline - time.monotonic()
+        if wait <= 0:
+            break
+        recv_msg = bus.recv(timeout=wait)
+        if recv_msg is None:
+            break
+
+        can_id, _ = decode_frame(recv_msg)
+        queue = pending.get(can_id)
+        if not queue:
+            continue
+        # 一括readの応答はdlc 8に2つの値、個別readの応答は1フレーム1つの値
+        # (個別readの応答がdlc 8に詰められていても2つ目は読まない)
+        size = (recv_msg.dlc & ~3) if can_id in combined_set else 4
+        for (recv_data,) in _INT32.iter_unpack(
+                memoryview(recv_msg.data)[:min(size, recv_msg.dlc & ~3)]):
+            if not queue:
+                break
+            values[can_id][queue.popleft()] = recv_data / 1000.0
+            remaining -= 1
+        timestamps[can_id] = recv_msg.timestamp
+
+    quiet_until = time.monotonic() + READ_QUIET_PERIOD
+    for can_id in can_ids:
+        if pending[can_id]:
+            _read_quiet_until[can_id] = quiet_until
+
+    # 一括read命令に全く応答しなかったモータは個別read命令で読み直す。
+    # 1回の遅れで未対応としないよう、連続してCOMBINED_READ_MAX_MISSES回
+    # 応答しなかった場合のみcombined_read_unsupportedに加える
+    fallback = []
+    for can_id in combined:
+        if len(pending[can_id]) == len(table_addrs):
+            fallback.append(can_id)
+            misses = _combined_read_misses.get(can_id, 0) + 1
+            _combined_read_misses[can_id] = misses
+            if misses >= COMBINED_READ_MAX_MISSES:
+                combined_read_unsupported.add(can_id)
+        else:
+            _combined_read_misses.pop(can_id, None)
+    if fallback:
+        for can_id, state in read_state(fallback, bus, table_addrs, timeout,
+                                        combined_read=False).items():
+            values[can_id] = state.values
+            if state.timestamp is not None:
+                timestamps[can_id] = state.timestamp
+
+    return {
+        can_id: MotorState(can_id, values[can_id], timestamps.get(can_id))
+        for can_id in can_ids
+    }
+
+
 def read_pos(can_id, bus):
     send_read_pos_instruction(can_id, bus)
     motor_id, recv_data = receive_frame(0.001, bus)
-    if (motor_id is not can_id):
+    if (motor_id != can_id):
 
         return None, None
     return motor_id, recv_data / 1000.0
@@ -229,7 +604,339 @@ def read_pos(can_id, bus):
 def read_vel(can_id, bus):
     send_read_vel_instruction(can_id, bus)
     motor_id, recv_data = receive_frame(0.001, bus)
-    if (motor_id is not can_id):
+    if (motor_id != can_id):
         return None, None
 
     return motor_id, recv_data / 1000.0
+
+
+class CanDispatcher:
+    """受信スレッドでバスを読み続け、モータ・アドレスごとの最新値を保持する
+
+    応答フレームにはテーブルアドレスが含まれないため、read命令はcan_idごとに
+    1つまでとし、届いた応答をそのアドレスの値とする。
+    response_timeout内に応答がなかった場合は応答待ちを破棄し、遅れた応答を
+    次のread命令の値としないよう、さらにresponse_timeoutの間そのモータへの
+    read命令を送らず、届いた応答を捨てる。応答待ちのない応答も捨てる。
+    start()後は、同じbusに対してreceive_frame/read_pos/read_velを呼ばないこと。
+
+    Attributes:
+        bus: can_bus
+        period: recvのタイムアウト [s]
+        response_timeout: 応答待ちを破棄するまでの時間 [s] (実際の応答時間より少し長く)
+        error: 受信スレッドを止めた例外。以降のget/requestはRuntimeErrorを送出する
+    """
+
+    def __init__(self, bus, period=0.01, response_timeout=0.005):
+        self.bus = bus
+        self.period = period
+        self.response_timeout = response_timeout
+        self.error = None
+
+        self._pending = {}  # can_id -> (table_addr, 送信時刻)
+        self._quiet_until = {}  # can_id -> 次のread命令を送れる時刻
+        self._latest = {}  # (can_id, table_addr) -> (value, timestamp)
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """受信スレッドを開始する"""
+        if self._running:
+            return
+        self.error = None
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """受信スレッドを停止する"""
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        try:
+            while self._running:
+                recv_msg = self.bus.recv(timeout=self.period)
+                if recv_msg is None:
+                    continue
+                self._dispatch(recv_msg)
+        except Exception as e:
+            # 古い値を返し続けないよう、get/requestで知らせる
+            self.error = e
+            self._running = False
+
+    def _check_error(self):
+        if self.error is not None:
+            raise RuntimeError("CanDispatcher receive thread stopped: %r" %
+                               self.error) from self.error
+
+    def _expire(self, can_id, now):
+        # _lock内で呼ぶ。応答が来ないままresponse_timeoutを過ぎたread命令を捨てる
+        entry = self._pending.get(can_id)
+        if entry is not None and now - entry[1] > self.response_timeout:
+            del self._pending[can_id]
+            # 遅れた応答が届き終わるまで次のread命令を送らない
+            self._quiet_until[can_id] = now + self.response_timeout
+            entry = None
+        return entry
+
+    def _dispatch(self, recv_msg):
+        can_id, recv_data = decode_frame(recv_msg)
+        if can_id is None:
+            return
+
+        with self._lock:
+            # 応答待ちのない応答 (破棄した後に遅れて届いた等) は捨てる
+            if self._expire(can_id, time.monotonic()) is None:
+                return
+            table_addr = self._pending.pop(can_id)[0]
+            self._latest[(can_id, table_addr)] = (recv_data / 1000.0,
+                                                  recv_msg.timestamp)
+
+    def request(self, can_id, table_addr):
+        """read命令を送信し、応答待ちとして登録する。応答は待たない
+        同じcan_idの応答待ちがある場合と、応答待ちを破棄した直後は送信しない
+
+        Args:
+            can_id
+            table_addr コントロールテーブルアドレス
+
+        Returns:
+            bool: 送信したか
+
+        Raises:
+            RuntimeError: 受信スレッドが例外で止まっている場合
+        """
+        self._check_error()
+        with self._lock:
+            now = time.monotonic()
+            if self._expire(can_id, now) is not None:
+                return False
+            if now < self._quiet_until.get(can_id, 0.0):
+                return False
+            self._pending[can_id] = (table_addr, now)
+        send_read_instruction(can_id, table_addr, self.bus)
+        return True
+
+    def request_many(self, can_ids, table_addr):
+        """複数モータへread命令を連続で送信する
+
+        Args:
+            can_ids Iterable[can_id]
+            table_addr コントロールテーブルアドレス
+
+        Returns:
+            int: 送信したread命令の数
+        """
+        return sum(self.request(can_id, table_addr) for can_id in can_ids)
+
+    def request_pos(self, can_id):
+        return self.request(can_id, 4)
+
+    def request_vel(self, can_id):
+        return self.request(can_id, 5)
+
+    def get(self, can_id, table_addr):
+        """最新値を取得する。ブロックしない
+
+        Args:
+            can_id
+            table_addr コントロールテーブルアドレス
+
+        Returns: (value, timestamp) 未受信の場合 (None, None)
+
+        Raises:
+            RuntimeError: 受信スレッドが例外で止まっている場合
+        """
+        self._check_error()
+        return self._latest.get((can_id, table_addr), (None, None))
+
+    def get_pos(self, can_id):
+        return self.get(can_id, 4)
+
+    def get_vel(self, can_id):
+        return self.get(can_id, 5)
+
+
+class AsyncCanClient:
+    """asyncio用canクライアント
+    python-canのNotifierでイベントループ上に受信し、応答をawaitで待つ。
+    set_*/read_*はモジュールの関数と同じ意味を持つ
+
+    使い方:
+        async with AsyncCanClient(bus) as client:
+            await client.set_goal_vel(can_id, 1.0)
+            motor_id, pos = await client.read_pos(can_id)
+            positions = await client.read_pos_many(can_ids)
+
+    Attributes:
+        bus: can_bus
+        timeout: read_*の応答待ち時間 [s]
+        response_timeout: タイムアウト後、遅れて届く応答を待ってから
+                          同じcan_idの次のread命令を送るまでの時間 [s]
+    """
+
+    def __init__(self, bus, timeout=0.001, response_timeout=0.005):
+        self.bus = bus
+        self.timeout = timeout
+        self.response_timeout = response_timeout
+
+        # 応答にはテーブルアドレスがないため、read命令はcan_idごとに1つまで
+        self._waiters = {}  # can_id -> future
+        self._locks = {}  # can_id -> asyncio.Lock
+        self._quiet_until = {}  # can_id -> 次のread命令を送れる時刻
+        self._notifier = None
+        self._loop = None
+
+    async def start(self):
+        """受信を開始する"""
+        self._loop = asyncio.get_running_loop()
+        self._notifier = can.Notifier(self.bus, [self._on_message],
+                                      timeout=0.1,
+                                      loop=self._loop)
+
+    async def stop(self):
+        """受信を停止する"""
+        if self._notifier is not None:
+            self._notifier.stop()
+            self._notifier = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    def _on_message(self, recv_msg):
+        # Notifierからイベントループ上で呼ばれる
+        can_id, recv_data = decode_frame(recv_msg)
+        if can_id is None:
+            return
+
+        # 待っているreadがない応答 (タイムアウト後に遅れて届いた等) は捨てる
+        future = self._waiters.pop(can_id, None)
+        if future is not None and not future.done():
+            future.set_result(recv_data)
+
+    async def read(self, can_id, table_addr, timeout=None):
+        """read命令を送信し、応答を待つ
+        同じcan_idのreadは順に1つずつ行う
+
+        Args:
+            can_id
+            table_addr コントロールテーブルアドレス
+            timeout 応答待ち時間 [s] Noneの場合self.timeout
+
+        Returns: (can_id, value) タイムアウト時 (None, None)
+        """
+        lock = self._locks.get(can_id)
+        if lock is None:
+            lock = self._locks.setdefault(can_id, asyncio.Lock())
+
+        async with lock:
+            # 直前のreadがタイムアウトした場合、遅れた応答が届き終わるまで待つ
+            delay = self._quiet_until.get(can_id, 0.0) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            future = self._loop.create_future()
+            self._waiters[can_id] = future
+            send_read_instruction(can_id, table_addr, self.bus)
+            try:
+                recv_data = await asyncio.wait_for(
+                    future, self.timeout if timeout is None else timeout)
+            except asyncio.TimeoutError:
+                self._quiet_until[can_id] = (time.monotonic() +
+                                             self.response_timeout)
+                return None, None
+            finally:
+                if self._waiters.get(can_id) is future:
+                    del self._waiters[can_id]
+        return can_id, recv_data / 1000.0
+
+    async def read_pos(self, can_id):
+        return await self.read(can_id, 4)
+
+    async def read_vel(self, can_id):
+        return await self.read(can_id, 5)
+
+    async def read_many(self, can_ids, table_addr, timeout=None):
+        """複数モータのread命令をまとめて送信し、応答を並行して待つ
+
+        Args:
+            can_ids Iterable[can_id]
+            table_addr コントロールテーブルアドレス
+            timeout 応答待ち時間 [s] Noneの場合self.timeout
+
+        Returns: dict {can_id: value} タイムアウトしたモータはNone
+        """
+        can_ids = list(can_ids)
+        results = await asyncio.gather(
+            *(self.read(can_id, table_addr, timeout) for can_id in can_ids))
+        return {
+            can_id: value for can_id, (_, value) in zip(can_ids, results)
+        }
+
+    async def read_pos_many(self, can_ids):
+        return await self.read_many(can_ids, 4)
+
+    async def read_vel_many(self, can_ids):
+        return await self.read_many(can_ids, 5)
+
+    async def set_stop_mode(self, can_id):
+        set_stop_mode(can_id, self.bus)
+
+    async def set_enc_pos_mode(self, can_id):
+        set_enc_pos_mode(can_id, self.bus)
+
+    async def set_potentio_pos_mode(self, can_id):
+        set_potentio_pos_mode(can_id, self.bus)
+
+    async def set_enc_vel_mode(self, can_id):
+        set_enc_vel_mode(can_id, self.bus)
+
+    async def set_pwm_mode(self, can_id):
+        set_pwm_mode(can_id, self.bus)
+
+    async def set_air_mode(self, can_id):
+        set_air_mode(can_id, self.bus)
+
+    async def set_goal_pos(self, can_id, data):
+        set_goal_pos(can_id, data, self.bus)
+
+    async def set_goal_vel(self, can_id, data):
+        set_goal_vel(can_id, data, self.bus)
+
+    async def set_goal_pwm(self, can_id, data):
+        set_goal_pwm(can_id, data, self.bus)
+
+    async def set_goal_pos_many(self, goals):
+        set_goal_pos_many(goals, self.bus)
+
+    async def set_goal_vel_many(self, goals):
+        set_goal_vel_many(goals, self.bus)
+
+    async def set_goal_pwm_many(self, goals):
+        set_goal_pwm_many(goals, self.bus)
+
+    async def set_air(self, can_id, data):
+        set_air(can_id, data, self.bus)
+
+    async def set_motor_rot_dir(self, can_id, data):
+        set_motor_rot_dir(can_id, data, self.bus)
+
+    async def set_profile_vel(self, can_id, data):
+        set_profile_vel(can_id, data, self.bus)
+
+    async def set_profile_accel(self, can_id, data):
+        set_profile_accel(can_id, data, self.bus)
+
+    async def set_pos_pid_gain(self, can_id, p_gain, i_gain, d_gain):
+        set_pos_pid_gain(can_id, p_gain, i_gain, d_gain, self.bus)
+
+    async def set_vel_pid_gain(self, can_id, p_gain, i_gain, d_gain):
+        set_vel_pid_gain(can_id, p_gain, i_gain, d_gain, self.bus)
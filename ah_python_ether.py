@@ -1,6 +1,47 @@
+import asyncio
 import socket
 import time
 import struct
+import numpy as np
+
+# パッケージとしても、このディレクトリから単体でもimportできるようにする
+try:
+    from .ah_struct_dtype import dtype_from_struct_format
+except ImportError:
+    from ah_struct_dtype import dtype_from_struct_format
+
+ESP32_PORT = 8888
+
+_PACKET = struct.Struct("<III")  # I=uint32_t
+
+# esp32_id -> (ip, port)
+_esp32_addrs = {}
+
+
+def esp32_addr(esp32_id):
+    """esp32_idの送信先アドレスを返す。一度作ったものは使い回す
+
+    Args:
+        esp32_id (int): ipアドレスの最下位
+
+    Returns:
+        tuple: (ip, port)
+    """
+    addr = _esp32_addrs.get(esp32_id)
+    if addr is None:
+        addr = ("192.168.10." + str(esp32_id), ESP32_PORT)
+        _esp32_addrs[esp32_id] = addr
+    return addr
+
+
+def set_esp32_addr(esp32_id, addr):
+    """esp32_idの送信先アドレスを変更する (試験用にloopbackへ向ける等)
+
+    Args:
+        esp32_id (int)
+        addr (tuple): (ip, port)
+    """
+    _esp32_addrs[esp32_id] = addr
 
 
 def init_udp():
@@ -14,12 +55,7 @@ def init_udp():
 
 
 def udp_send(esp32_id, motor_id, table_addr, data, sock):
-    ESP32_IP = "192.168.10." + str(esp32_id)
-    ESP32_PORT = 8888
-    packet_format = "<III"  # I=uint32_t
-
-    binary_data = struct.pack(packet_format, motor_id, table_addr, data)
-    sock.sendto(binary_data, (ESP32_IP, ESP32_PORT))
+    sock.sendto(_PACKET.pack(motor_id, table_addr, data), esp32_addr(esp32_id))
 
 
 def udp_receive(packet_format, sock):
@@ -27,3 +63,293 @@ def udp_receive(packet_format, sock):
     unpacked_data = struct.unpack(packet_format, data)
 
     return unpacked_data
+
+
+def pack_entries(entries):
+    """(motor_id, table_addr, data) のリストを"<III"を並べた1つのデータグラムにする
+
+    Args:
+        entries (list[tuple]): (motor_id, table_addr, data) のリスト
+
+    Returns:
+        bytearray: データグラム
+    """
+    datagram = bytearray(_PACKET.size * len(entries))
+    offset = 0
+    for motor_id, table_addr, data in entries:
+        _PACKET.pack_into(datagram, offset, motor_id, table_addr, data)
+        offset += _PACKET.size
+    return datagram
+
+
+def udp_send_many(esp32_id, entries, sock):
+    """1つのesp32への複数の書き込みを1つのデータグラムにまとめて送信する
+    esp32側はデータグラムを12byte("<III")ごとに処理する
+
+    Args:
+        esp32_id (int): ipアドレスの最下位
+        entries (list[tuple]): (motor_id, table_addr, data) のリスト
+        sock: udpソケット
+    """
+    sock.sendto(pack_entries(entries), esp32_addr(esp32_id))
+
+
+def udp_send_fanout(commands, sock):
+    """複数のesp32へ、それぞれ1つのデータグラムで送信する
+
+    Args:
+        commands (dict): {esp32_id: [(motor_id, table_addr, data), ...]}
+        sock: udpソケット
+    """
+    for esp32_id, entries in commands.items():
+        sock.sendto(pack_entries(entries), esp32_addr(esp32_id))
+
+
+def udp_receive_buffer(n, packet_format="<III", names=None):
+    """udp_receive_manyの受信先の配列を作る
+
+    Args:
+        n (int): 1回に受信する最大パケット数
+        packet_format (str): 受信パケットのフォーマット
+        names (list[str]): フィールド名
+
+    Returns:
+        np.ndarray: 構造化配列 (1行が1パケット)
+    """
+    return np.zeros(n, dtype=dtype_from_struct_format(packet_format, names))
+
+
+def udp_receive_many(out, sock, senders=None):
+    """受信キューにある全てのデータグラムを、outの各行に直接読み込む。ブロックしない
+    長さがパケットと合わないデータグラムは捨てる
+
+    Args:
+        out (np.ndarray): udp_receive_bufferで作った配列
+        sock: udpソケット
+        senders (list): 指定した場合、各行の送信元アドレスをこのリストに入れ直す
+
+    Returns:
+        int: 読み込んだパケット数 (outの行数まで)
+    """
+    size = out.dtype.itemsize
+    view = memoryview(out.view(np.uint8))
+    # MSG_TRUNC: 長すぎるデータグラムも元の長さを返させる
+    flags = socket.MSG_DONTWAIT | getattr(socket, "MSG_TRUNC", 0)
+    if senders is not None:
+        del senders[:]
+
+    n = 0
+    offset = 0
+    while n < len(out):
+        try:
+            if senders is None:
+                nbytes = sock.recv_into(view[offset:offset + size], size,
+                                        flags)
+            else:
+                nbytes, addr = sock.recvfrom_into(view[offset:offset + size],
+                                                  size, flags)
+        except BlockingIOError:
+            break
+        if nbytes == size:
+            n += 1
+            offset += size
+            if senders is not None:
+                senders.append(addr)
+    return n
+
+
+class EspUdpEndpoint(asyncio.DatagramProtocol):
+    """asyncio用のudp通信クラス
+    1つのイベントループで複数のesp32とスレッドなしで通信する。
+    on_packetを指定した場合は受信ごとに呼び出し、指定しない場合はrecv()で待つ
+
+    使い方:
+        endpoint = await open_udp_endpoint()
+        endpoint.send(esp32_id, motor_id, table_addr, data)
+        packet, addr = await endpoint.recv()
+
+    Attributes:
+        packet_struct: 受信パケットのstruct
+        on_packet: 受信時に呼ぶ関数 on_packet(packet, addr)
+        esp32_addrs: esp32_id -> (ip, port) 指定がないidはesp32_addr()
+        stats: 受信統計
+            received     : 受信したパケット数
+            format_error : 長さが合わず捨てたパケット数
+            dropped      : recv()の待ち行列が一杯で捨てたパケット数
+    """
+
+    def __init__(self, packet_format="<III", on_packet=None, esp32_addrs=None,
+                 max_queue=1024):
+        self.packet_struct = struct.Struct(packet_format)
+        self.on_packet = on_packet
+        self.esp32_addrs = dict(esp32_addrs or {})
+        self.stats = {"received": 0, "format_error": 0, "dropped": 0}
+        self.transport = None
+
+        self._queue = asyncio.Queue(max_queue)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            packet = self.packet_struct.unpack(data)
+        except struct.error:
+            self.stats["format_error"] += 1
+            return
+        self.stats["received"] += 1
+
+        if self.on_packet is not None:
+            self.on_packet(packet, addr)
+            return
+        try:
+            self._queue.put_nowait((packet, addr))
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+
+    def addr_of(self, esp32_id):
+        """esp32_idの送信先アドレスを返す"""
+        addr = self.esp32_addrs.get(esp32_id)
+        if addr is None:
+            addr = esp32_addr(esp32_id)
+            self.esp32_addrs[esp32_id] = addr
+        return addr
+
+    def send(self, esp32_id, motor_id, table_addr, data):
+        """udp_sendと同じパケットを送信する。ブロックしない"""
+        self.transport.sendto(_PACKET.pack(motor_id, table_addr, data),
+                              self.addr_of(esp32_id))
+
+    def send_many(self, esp32_id, entries):
+        """udp_send_manyと同じデータグラムを送信する。ブロックしない"""
+        self.transport.sendto(pack_entries(entries), self.addr_of(esp32_id))
+
+    async def recv(self):
+        """パケットを1つ受信する
+
+        Returns:
+            tuple: (packet, addr)
+        """
+        return await self._queue.get()
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+
+async def open_udp_endpoint(local_addr=("0.0.0.0", 12345),
+                            endpoint_class=None,
+                            **kwargs):
+    """EspUdpEndpointを作成し、local_addrで受信を開始する
+
+    Args:
+        local_addr (tuple): 受信アドレス
+        endpoint_class: 作成するクラス。Noneの場合EspUdpEndpoint
+        kwargs: endpoint_classの引数
+
+    Returns:
+        EspUdpEndpoint
+    """
+    if endpoint_class is None:
+        endpoint_class = EspUdpEndpoint
+    loop = asyncio.get_running_loop()
+    _, endpoint = await loop.create_datagram_endpoint(
+        lambda: endpoint_class(**kwargs), local_addr=local_addr)
+    return endpoint
+
+
+_SEQ_PACKET = struct.Struct("<IIII")  # seq, motor_id, table_addr, data
+
+
+class SequencedUdpEndpoint(EspUdpEndpoint):
+    """シーケンス番号付きの要求/応答でudp通信するクラス
+    要求パケットは "<IIII" (seq, motor_id, table_addr, data)。
+    esp32は受け取ったseqを応答パケットの先頭に入れて返す。
+    応答がtimeout内に来なければretries回まで再送し、応答を要求のfutureに対応付ける
+
+    使い方:
+        endpoint = await open_udp_endpoint(endpoint_class=SequencedUdpEndpoint)
+        reply = await endpoint.request(esp32_id, motor_id, table_addr, data)
+
+    Attributes:
+        timeout: 1回の送信の応答待ち時間 [s]
+        retries: 再送回数の上限
+        stats: 受信統計 (EspUdpEndpointに加えて)
+            retransmit : 再送した回数
+            timeout    : 再送しても応答がなかった要求数
+            unmatched  : 対応する要求がない応答数 (再送後に遅れて届いた応答等)
+    """
+
+    def __init__(self, packet_format="<IIII", timeout=0.02, retries=3,
+                 max_in_flight=64, **kwargs):
+        super().__init__(packet_format, **kwargs)
+        self.timeout = timeout
+        self.retries = retries
+        self.stats.update({"retransmit": 0, "timeout": 0, "unmatched": 0})
+
+        self._seq = 0
+        # seq -> [future, datagram, addr, 送信回数, タイマー]
+        self._in_flight = {}
+        self._slots = asyncio.Semaphore(max_in_flight)
+
+    def datagram_received(self, data, addr):
+        try:
+            packet = self.packet_struct.unpack(data)
+        except struct.error:
+            self.stats["format_error"] += 1
+            return
+        self.stats["received"] += 1
+
+        entry = self._in_flight.pop(packet[0], None)
+        if entry is None:
+            self.stats["unmatched"] += 1
+            return
+        future, _, _, _, timer = entry
+        timer.cancel()
+        if not future.done():
+            future.set_result(packet[1:])
+
+    def _on_timeout(self, seq):
+        entry = self._in_flight.get(seq)
+        if entry is None:
+            return
+        future, datagram, addr, attempts, _ = entry
+        if attempts > self.retries or future.done():
+            del self._in_flight[seq]
+            self.stats["timeout"] += 1
+            if not future.done():
+                future.set_exception(asyncio.TimeoutError())
+            return
+
+        self.stats["retransmit"] += 1
+        self._transmit(seq, future, datagram, addr, attempts)
+
+    def _transmit(self, seq, future, datagram, addr, attempts):
+        self.transport.sendto(datagram, addr)
+        timer = asyncio.get_running_loop().call_later(self.timeout,
+                                                      self._on_timeout, seq)
+        self._in_flight[seq] = [future, datagram, addr, attempts + 1, timer]
+
+    async def request(self, esp32_id, motor_id, table_addr, data):
+        """要求を送信し、応答を待つ。応答がなければ再送する
+
+        Returns:
+            tuple: 応答パケット (seqを除く)
+
+        Raises:
+            asyncio.TimeoutError: 再送しても応答がなかった場合
+        """
+        async with self._slots:
+            self._seq = (self._seq + 1) & 0xFFFFFFFF
+            seq = self._seq
+            future = asyncio.get_running_loop().create_future()
+            datagram = _SEQ_PACKET.pack(seq, motor_id, table_addr, data)
+            self._transmit(seq, future, datagram, self.addr_of(esp32_id), 0)
+            try:
+                return await future
+            finally:
+                # キャンセルされた場合も含めて後始末する
+                entry = self._in_flight.pop(seq, None)
+                if entry is not None:
+                    entry[4].cancel()
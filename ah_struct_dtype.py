@@ -0,0 +1,78 @@
+"""structのフォーマットからnumpyの構造化dtypeを作る
+受信バイト列をnumpy配列に直接読み込むとき (ah_python_ether) や、
+パケットを記録するとき (ah_telemetry) に使う"""
+
+import re
+import struct
+import numpy as np
+
+# structのフォーマット文字 -> numpyの型の種類 (サイズはstructから求める)
+_STRUCT_TO_KIND = {
+    "b": "i",
+    "B": "u",
+    "?": "b",
+    "h": "i",
+    "H": "u",
+    "i": "i",
+    "I": "u",
+    "l": "i",
+    "L": "u",
+    "q": "i",
+    "Q": "u",
+    "e": "f",
+    "f": "f",
+    "d": "f",
+}
+
+# structのバイトオーダー指定 -> numpyのバイトオーダー
+_STRUCT_TO_ORDER = {"@": "=", "=": "=", "<": "<", ">": ">", "!": ">"}
+
+
+def dtype_from_struct_format(struct_format, names=None):
+    """struct_formatと同じ配置のnumpy構造化dtypeを作る
+    パディング ("x") とネイティブのアライメント (先頭が"@"または指定なし) も
+    structと同じオフセットにし、itemsizeはstruct.calcsize(struct_format)と一致する
+
+    Args:
+        struct_format (str): structのフォーマット ("<BiiB" 等)
+        names (list[str]): フィールド名。Noneの場合 f0, f1, ...
+
+    Returns:
+        np.dtype: 構造化dtype
+
+    Raises:
+        ValueError: 対応していないフォーマット文字の場合
+    """
+    prefix = "@"
+    body = struct_format.replace(" ", "")
+    if body and body[0] in _STRUCT_TO_ORDER:
+        prefix, body = body[0], body[1:]
+    order = _STRUCT_TO_ORDER[prefix]
+
+    types = []
+    offsets = []
+    done = ""  # 処理済みのフォーマット
+    for count, code in re.findall(r"(\d*)(\D)", body):
+        count = int(count or 1)
+        if code == "x":
+            done += "%dx" % count
+            continue
+        if code not in _STRUCT_TO_KIND:
+            raise ValueError("unsupported struct format: " + code)
+        size = struct.calcsize(prefix + code)
+        for _ in range(count):
+            # アライメントのパディングを含めた末尾からフィールドのサイズを引く
+            done += code
+            offsets.append(struct.calcsize(prefix + done) - size)
+            types.append(order + _STRUCT_TO_KIND[code] + str(size))
+
+    if names is None:
+        names = ["f%d" % i for i in range(len(types))]
+    if len(names) != len(types):
+        raise ValueError("names must have %d entries" % len(types))
+    return np.dtype({
+        "names": list(names),
+        "formats": types,
+        "offsets": offsets,
+        "itemsize": struct.calcsize(struct_format),
+    })
@@ -0,0 +1,143 @@
+"""feedbackパケットを記録する固定長リングバッファ
+長時間記録してもメモリが増えず、必要ならディスク上の.npyにも書き出す"""
+
+import time
+import numpy as np
+
+# パッケージとしても、このディレクトリから単体でもimportできるようにする
+try:
+    from .ah_struct_dtype import dtype_from_struct_format
+except ImportError:
+    from ah_struct_dtype import dtype_from_struct_format
+
+
+class TelemetryRecorder:
+    """受信パケットを固定長のリングバッファに記録する
+    先頭に受信時刻の"stamp"フィールドを加えて記録する。
+    同じ値をバッファの2箇所に書くことで、最新N件を常にコピーなしの連続したviewで返す
+
+    使い方:
+        recorder = TelemetryRecorder.from_struct_format("<BiiB", 60000)
+        recorder.record_many(decoder.read(ser))
+        latest = recorder.latest(1000)
+
+    Attributes:
+        packet_dtype: パケットの構造化dtype
+        dtype: 記録する構造化dtype (stamp + パケットのフィールド)
+        capacity: リングバッファに保持する件数
+        count: これまでに記録した件数
+        spill: ディスク上の.npy (spill_pathを指定した場合)
+        spill_dropped: spill_capacityを超えて書き出せなかった件数
+    """
+
+    def __init__(self, dtype, capacity, spill_path=None, spill_capacity=None):
+        self.packet_dtype = np.dtype(dtype)
+        self.dtype = np.dtype([("stamp", "<f8")] + [
+            (name, self.packet_dtype.fields[name][0])
+            for name in self.packet_dtype.names
+        ])
+        self.capacity = capacity
+        self.count = 0
+
+        self._ring = np.zeros(2 * capacity, dtype=self.dtype)
+
+        self.spill = None
+        self.spill_dropped = 0
+        if spill_path is not None:
+            self.spill = np.lib.format.open_memmap(
+                spill_path,
+                mode="w+",
+                dtype=self.dtype,
+                shape=(spill_capacity or capacity,))
+
+    @classmethod
+    def from_struct_format(cls, struct_format, capacity, names=None,
+                           **kwargs):
+        """struct_formatのパケットを記録するレコーダを作る
+
+        Args:
+            struct_format (str): structのフォーマット
+            capacity (int): リングバッファに保持する件数
+            names (list[str]): フィールド名
+        """
+        return cls(dtype_from_struct_format(struct_format, names), capacity,
+                   **kwargs)
+
+    def record(self, packet, stamp=None):
+        """パケットを1件記録する
+
+        Args:
+            packet (tuple): デコード済みのパケット
+            stamp (float): 受信時刻。Noneの場合time.monotonic()
+        """
+        if stamp is None:
+            stamp = time.monotonic()
+        row = (stamp,) + tuple(packet)
+
+        i = self.count % self.capacity
+        self._ring[i] = row
+        self._ring[i + self.capacity] = row
+
+        if self.spill is not None:
+            if self.count < len(self.spill):
+                self.spill[self.count] = row
+            else:
+                self.spill_dropped += 1
+        self.count += 1
+
+    def record_many(self, packets, stamp=None):
+        """複数のパケットを同じ受信時刻でまとめて記録する
+
+        Args:
+            packets (list[tuple]): デコード済みのパケット
+            stamp (float): 受信時刻。Noneの場合time.monotonic()
+        """
+        if not packets:
+            return
+        if stamp is None:
+            stamp = time.monotonic()
+
+        rows = np.empty(len(packets), dtype=self.dtype)
+        rows["stamp"] = stamp
+        values = np.array(packets, dtype=self.packet_dtype)
+        for name in self.packet_dtype.names:
+            rows[name] = values[name]
+
+        if self.spill is not None:
+            n_spill = min(max(len(self.spill) - self.count, 0), len(rows))
+            self.spill[self.count:self.count + n_spill] = rows[:n_spill]
+            self.spill_dropped += len(rows) - n_spill
+
+        # capacityを超える分は古いものが上書きされるので最後のcapacity件だけ書く
+        skipped = max(len(rows) - self.capacity, 0)
+        rows = rows[skipped:]
+        index = (self.count + skipped + np.arange(len(rows))) % self.capacity
+        self._ring[index] = rows
+        self._ring[index + self.capacity] = rows
+        self.count += skipped + len(rows)
+
+    def latest(self, n):
+        """最新n件を古い順に返す。コピーせず読み取り専用のviewを返す
+
+        Args:
+            n (int): 件数 (capacityまで)
+
+        Returns:
+            np.ndarray: 構造化配列のview
+        """
+        n = min(n, self.count, self.capacity)
+        end = (self.count - 1) % self.capacity + 1 + self.capacity
+        view = self._ring[end - n:end]
+        view.flags.writeable = False
+        return view
+
+    def flush(self):
+        """spillをディスクに書き出す"""
+        if self.spill is not None:
+            self.spill.flush()
+
+    def close(self):
+        """spillを閉じる"""
+        if self.spill is not None:
+            self.spill.flush()
+            self.spill = None
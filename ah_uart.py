@@ -4,10 +4,40 @@
   packet_length : 1byte
 """
 
+import threading
 import time
 import serial
 import struct
 import numpy as np
+from collections import deque
+
+# パッケージとしても、このディレクトリから単体でもimportできるようにする
+try:
+    from .ah_framing import PacketBuilder, calc_checksum
+except ImportError:
+    from ah_framing import PacketBuilder, calc_checksum
+
+# sync_write/sync_readのmotor_id欄に入れる識別子
+SYNC_WRITE_ID = 0xFE
+SYNC_READ_ID = 0xFD
+# 1パケットあたりの最大エントリ数 (packet_lengthが1byteに収まる数)
+SYNC_MAX_ENTRIES = 41
+# sync_readで応答がまだ届いていないときに待つ間隔 [s]
+SYNC_READ_POLL_INTERVAL = 0.0002
+
+_INT32 = struct.Struct("<i")
+_SYNC_WRITE_ENTRY = struct.Struct("<BBi")
+
+# 送信パケット組み立て用バッファ (スレッドごと)
+_local = threading.local()
+
+
+def _builder():
+    try:
+        return _local.builder
+    except AttributeError:
+        _local.builder = PacketBuilder()
+        return _local.builder
 
 
 def send_4value_by_one_packet(table_addr, target_1, target_2, target_3, target_4, ser):
@@ -21,78 +51,28 @@ def send_4value_by_one_packet(table_addr, target_1, target_2, target_3, target_4
         target_4 値4
         ser シリアルインスタンス
     """
-    header = 0xAA
-    data_length = 21
-    target_1 = int(target_1 * 1000)
-    target_2 = int(target_2 * 1000)
-    target_3 = int(target_3 * 1000)
-    target_4 = int(target_4 * 1000)
-
-    # int32をバイト列に変換
-    byte_array_1 = from_int32_to_bytes(target_1)
-    byte_array_2 = from_int32_to_bytes(target_2)
-    byte_array_3 = from_int32_to_bytes(target_3)
-    byte_array_4 = from_int32_to_bytes(target_4)
-
-    packet = (
-        [header, data_length, 0, table_addr]
-        + byte_array_1
-        + byte_array_2
-        + byte_array_3
-        + byte_array_4
-    )
-
-    check_sum_val = calc_checksum(packet)
-    packet.append(check_sum_val)
-
-    ser.write(bytes(packet))
+    # motor_idは0固定
+    packet = _builder().packet_4value(0, table_addr, int(target_1 * 1000),
+                                      int(target_2 * 1000),
+                                      int(target_3 * 1000),
+                                      int(target_4 * 1000))
+    ser.write(packet)
 
 
 # 1byte送信用
 def send_packet_1byte(motor_id, table_addr, data, ser):
-    header = 0xAA
-    data_length = 6
-
-    packet = [header, data_length, motor_id, table_addr, data]
-    check_sum_val = calc_checksum(packet)
-    packet.append(check_sum_val)
-
-    ser.write(bytes(packet))
+    ser.write(_builder().packet_1byte(motor_id, table_addr, data))
 
 
 # 4byte送信用
 def send_packet_4byte(motor_id, table_addr, data, ser):  # mode 1 is vel 2 is pos
-    data_int = int(data * 1000)
-    header = 0xAA
-    data_length = 9
-    byte_array = from_int32_to_bytes(data_int)
-
     # リトルエンディアン
-    packet = [
-        header,
-        data_length,
-        motor_id,
-        table_addr,
-        byte_array[0],
-        byte_array[1],
-        byte_array[2],
-        byte_array[3],
-    ]
-
-    check_sum_val = calc_checksum(packet)
-    packet.append(check_sum_val)
-
-    ser.write(bytes(packet))
+    ser.write(_builder().packet_4byte(motor_id, table_addr, int(data * 1000)))
 
 
 # read命令を送信
 def send_read_instruction(motor_id, table_addr, ser):
-    header = 0xAA
-    data_length = 5
-    packet = [header, data_length, motor_id, table_addr]
-    check_sum_val = calc_checksum(packet)
-    packet.append(check_sum_val)
-    ser.write(bytes(packet))
+    ser.write(_builder().read_instruction(motor_id, table_addr))
 
 
 def from_int32_to_bytes(value):
@@ -112,21 +92,6 @@ def from_int32_to_bytes(value):
     return [byte1, byte2, byte3, byte4]
 
 
-def calc_checksum(packet_data):
-    """排他的論理和チェックサムを計算する
-
-    Args:
-        packet_data (Iterable[int]): パケットデータ
-
-    Returns:
-        チェックサム値
-    """
-    checksum_val = 0
-    for i in range(0, len(packet_data)):
-        checksum_val ^= packet_data[i]
-    return checksum_val
-
-
 def receive_packet(data_array, ser):
     """受け取ったidのデータを、data_arrayに格納する
 
@@ -196,9 +161,354 @@ def receive_packet(data_array, ser):
     data_array[recv_id] = target / 1000.000
 
 
-def sync_write():
-    pass
+class PacketParser:
+    """受信バイト列からパケットを切り出すパーサ
+    ser.in_waitingの分を1回のreadでまとめて読み込んでバッファに溜め、
+    headerの位置で同期し直しながら、チェックサムの正しいパケットを全て取り出す
+
+    使い方:
+        parser = PacketParser()
+        while True:
+            parser.poll(data_array, ser)
+
+    Attributes:
+        max_packet_len: これより長いlengthは誤りとして捨てる
+        max_motor_id: これより大きいmotor_idのパケットは捨てる
+        stats: 受信統計
+            packets        : 取り出したパケット数
+            checksum_error : チェックサム誤りで捨てたパケット数
+            invalid_id     : motor_idが範囲外で捨てたパケット数
+            bytes_dropped  : 同期のために読み飛ばしたバイト数
+    """
+
+    HEADER = 0xAA
+    MIN_PACKET_LEN = 8  # header, length, motor_id, int32, checksum
+
+    def __init__(self, max_packet_len=64, max_motor_id=3):
+        self.max_packet_len = max_packet_len
+        self.max_motor_id = max_motor_id
+        self.stats = {
+            "packets": 0,
+            "checksum_error": 0,
+            "invalid_id": 0,
+            "bytes_dropped": 0,
+        }
+        self._buf = bytearray()
+
+    def feed(self, data):
+        """受信データを追加し、完成したパケットを取り出す
+
+        Args:
+            data (bytes): 受信データ
+
+        Returns:
+            list[tuple[int, float]]: (motor_id, value) のリスト
+        """
+        buf = self._buf
+        buf += data
+        stats = self.stats
+        packets = []
+
+        pos = 0
+        end = len(buf)
+        while True:
+            start = buf.find(self.HEADER, pos)
+            if start < 0:
+                stats["bytes_dropped"] += end - pos
+                pos = end
+                break
+            stats["bytes_dropped"] += start - pos
+            pos = start
+
+            # lengthがまだ届いていない
+            if end - start < 2:
+                break
+            packet_len = buf[start + 1]
+            if (packet_len < self.MIN_PACKET_LEN
+                    or packet_len > self.max_packet_len):
+                # headerではなかったので1byte進めて同期し直す
+                stats["bytes_dropped"] += 1
+                pos = start + 1
+                continue
+
+            # パケットの残りがまだ届いていない
+            if end - start < packet_len:
+                break
+
+            if calc_checksum(buf[start:start + packet_len]) != 0:
+                stats["checksum_error"] += 1
+                stats["bytes_dropped"] += 1
+                pos = start + 1
+                continue
+
+            pos = start + packet_len
+            recv_id = buf[start + 2]
+            if recv_id > self.max_motor_id:
+                stats["invalid_id"] += 1
+                continue
+
+            # リトルエンディアンのint32
+            target = _INT32.unpack_from(buf, start + 3)[0]
+            packets.append((recv_id, target / 1000.000))
+            stats["packets"] += 1
+
+        # 処理済みの部分を捨てる (bytearrayの先頭削除はコピーしない)
+        del buf[:pos]
+        return packets
+
+    def reset(self):
+        """溜めている受信途中のデータを捨てる"""
+        self.stats["bytes_dropped"] += len(self._buf)
+        self._buf.clear()
+
+    def read(self, ser):
+        """受信キューにあるデータを1回のreadで読み込み、パケットを取り出す
+        受信キューが空の場合は1byte分serのタイムアウトまで待つ
+
+        Args:
+            ser シリアルインスタンス
+
+        Returns:
+            list[tuple[int, float]]: (motor_id, value) のリスト
+        """
+        return self.feed(ser.read(ser.in_waiting or 1))
+
+    def poll(self, data_array, ser):
+        """受け取ったidのデータを、data_arrayに格納する
+
+        Args:
+            data_array: 各idのデータを格納するリスト (id : 0-3)
+            ser シリアルインスタンス
+
+        Returns:
+            int: 格納したパケット数
+        """
+        packets = self.read(ser)
+        for recv_id, value in packets:
+            data_array[recv_id] = value
+        return len(packets)
+
+
+def sync_write(entries, ser):
+    """複数モータ・アドレスへの4byte書き込みを1つのパケットにまとめて送信する
+    1000をかけて送信する、受信先で1000で割る
+
+    パケット構造
+      header : 1byte (0xAA)
+      packet_length : 1byte
+      SYNC_WRITE_ID : 1byte (0xFE)
+      count : 1byte
+      [motor_id : 1byte, table_addr : 1byte, value : 4byte] * count
+      checksum : 1byte
+
+    1パケットに入りきらない場合は複数パケットに分け、1回のwriteで送信する
+
+    Args:
+        entries (Iterable[tuple]): (motor_id, table_addr, value) のリスト
+        ser シリアルインスタンス
+    """
+    header = 0xAA
+    entries = list(entries)
+
+    packets = bytearray()
+    for i in range(0, len(entries), SYNC_MAX_ENTRIES):
+        chunk = entries[i:i + SYNC_MAX_ENTRIES]
+        packet = bytearray(
+            [header, 5 + 6 * len(chunk), SYNC_WRITE_ID,
+             len(chunk)])
+        for motor_id, table_addr, value in chunk:
+            packet += _SYNC_WRITE_ENTRY.pack(motor_id, table_addr,
+                                             int(value * 1000))
+        packet.append(calc_checksum(packet))
+        packets += packet
+
+    ser.write(packets)
+
+
+def send_sync_read_instruction(requests, ser):
+    """複数モータ・アドレスのread命令を1つのパケットにまとめて送信する。応答は待たない
+
+    パケット構造
+      header : 1byte (0xAA)
+      packet_length : 1byte
+      SYNC_READ_ID : 1byte (0xFD)
+      count : 1byte
+      [motor_id : 1byte, table_addr : 1byte] * count
+      checksum : 1byte
+
+    応答は通常の受信パケットで、要求順に返ってくる
+
+    Args:
+        requests (Iterable[tuple]): (motor_id, table_addr) のリスト
+        ser シリアルインスタンス
+    """
+    header = 0xAA
+    requests = list(requests)
+
+    packets = bytearray()
+    for i in range(0, len(requests), SYNC_MAX_ENTRIES):
+        chunk = requests[i:i + SYNC_MAX_ENTRIES]
+        packet = bytearray(
+            [header, 5 + 2 * len(chunk), SYNC_READ_ID,
+             len(chunk)])
+        for motor_id, table_addr in chunk:
+            packet += bytes((motor_id, table_addr))
+        packet.append(calc_checksum(packet))
+        packets += packet
+    ser.write(packets)
+
+
+def sync_read(requests, ser, parser=None, timeout=0.01):
+    """複数モータ・アドレスのread命令を1つのパケットにまとめて送信し、応答を集める
+    パケット構造はsend_sync_read_instructionを参照
 
+    Args:
+        requests (Iterable[tuple]): (motor_id, table_addr) のリスト
+        ser シリアルインスタンス
+        parser (PacketParser): 受信に使うパーサ。呼び出し間で使い回すこと
+        timeout (float): 全応答を待つ時間 [s]
+
+    Returns:
+        dict: {(motor_id, table_addr): value} 応答がなかったものは含まない
+    """
+    requests = list(requests)
+    if parser is None:
+        parser = PacketParser()
+
+    # 前回タイムアウトした要求への遅れた応答を今回の要求と対応付けないよう、
+    # 送信前に受信キューとパーサのバッファを捨てる
+    ser.reset_input_buffer()
+    parser.reset()
+    send_sync_read_instruction(requests, ser)
+
+    # 応答にはアドレスが含まれないので、motor_idごとに要求順で対応付ける
+    pending = {}
+    for motor_id, table_addr in requests:
+        pending.setdefault(motor_id, deque()).append(table_addr)
+
+    result = {}
+    remaining = len(requests)
+    deadline = time.monotonic() + timeout
+    while remaining > 0:
+        # ser.read(1)はser.timeoutまでブロックするので、届いた分だけ読む
+        n = ser.in_waiting
+        if not n:
+            wait = deadline - time.monotonic()
+            if wait <= 0:
+                break
+            time.sleep(min(wait, SYNC_READ_POLL_INTERVAL))
+            continue
+        for recv_id, value in parser.feed(ser.read(n)):
+            queue = pending.get(recv_id)
+            if not queue:
+                continue
+            result[(recv_id, queue.popleft())] = value
+            remaining -= 1
+
+    return result
+
+
+class UartLink:
+    """シリアルポートを持ち、受信スレッドで各モータの最新値を配列に書き込む
+    制御ループはsnapshot()で、I/Oを待たずに一貫した値の組を取得できる
+
+    portにはデバイスパスの他、pyserialのURL ("loop://" 等) も指定できる
+
+    使い方:
+        with UartLink("/dev/ttyUSB0") as link:
+            link.send_packet_4byte(0, 2, 1.0)
+            values, seq, stamps = link.snapshot()
+
+    Attributes:
+        ser: シリアルインスタンス
+        parser: PacketParser
+        values: 各モータの最新値
+        seq: 各モータの受信回数 (値が更新されたかの判定に使う)
+        stamps: 各モータの受信時刻 (time.monotonic)
+    """
 
-def sync_read():
-    pass
+    def __init__(self, port, baudrate=115200, n_motors=4, timeout=0.01):
+        self.ser = serial.serial_for_url(port, baudrate, timeout=timeout)
+        self.parser = PacketParser(max_motor_id=n_motors - 1)
+
+        self.values = np.zeros(n_motors)
+        self.seq = np.zeros(n_motors, dtype=np.uint64)
+        self.stamps = np.zeros(n_motors)
+
+        # 受信スレッドの書き込みとsnapshotのコピーを排他する
+        # (GILを持ったままのスピン待ちは書き込み側を止めてしまうのでLockで待つ)
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """受信スレッドを開始する"""
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """受信スレッドを停止する"""
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        """受信スレッドを停止し、シリアルポートを閉じる"""
+        self.stop()
+        self.ser.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _run(self):
+        while self._running:
+            packets = self.parser.read(self.ser)
+            if not packets:
+                continue
+
+            now = time.monotonic()
+            with self._lock:
+                for recv_id, value in packets:
+                    self.values[recv_id] = value
+                    self.seq[recv_id] += 1
+                    self.stamps[recv_id] = now
+
+    def snapshot(self):
+        """最新値の組を取得する。I/Oは待たない
+        受信スレッドが書き込み中の場合は、その書き込みが終わるまでだけ待つ
+
+        Returns:
+            tuple[np.ndarray]: (values, seq, stamps) のコピー
+        """
+        with self._lock:
+            return self.values.copy(), self.seq.copy(), self.stamps.copy()
+
+    def send_packet_1byte(self, motor_id, table_addr, data):
+        send_packet_1byte(motor_id, table_addr, data, self.ser)
+
+    def send_packet_4byte(self, motor_id, table_addr, data):
+        send_packet_4byte(motor_id, table_addr, data, self.ser)
+
+    def send_4value_by_one_packet(self, table_addr, target_1, target_2,
+                                  target_3, target_4):
+        send_4value_by_one_packet(table_addr, target_1, target_2, target_3,
+                                  target_4, self.ser)
+
+    def send_read_instruction(self, motor_id, table_addr):
+        """read命令を送信する。応答は受信スレッドがvaluesに書き込む"""
+        send_read_instruction(motor_id, table_addr, self.ser)
+
+    def sync_write(self, entries):
+        sync_write(entries, self.ser)
+
+    def send_sync_read_instruction(self, requests):
+        """一括read命令を送信する。応答は受信スレッドがvaluesに書き込む"""
+        send_sync_read_instruction(requests, self.ser)
@@ -1,13 +1,19 @@
 """dynamixel python library"""
 
 # usr/bin/env python3
+import math
 import os
+import queue
 import struct
 import threading
+import time
+from collections import namedtuple
+import numpy as np
 from dynamixel_sdk import *  # Uses Dynamixel SDK library
 
 # ********* DYNAMIXEL Model definition *********
 # ***** (Use only one definition at a time) *****
+# pingでモデル番号が分からないサーボにはこのシリーズを使う
 MY_DXL = "X_SERIES"  # X330 (5.0 V recommended), X430, X540, 2X430
 # MY_DXL = 'MX_SERIES'    # MX series with 2.0 firmware update.
 # MY_DXL = 'PRO_SERIES'   # H54, H42, M54, M42, L54, L42
@@ -15,58 +21,244 @@ MY_DXL = "X_SERIES"  # X330 (5.0 V recommended), X430, X540, 2X430
 # MY_DXL = 'PRO_A_SERIES' # PRO series with (A) firmware update.
 # MY_DXL = 'XL320'        # [WARNING] Operating Voltage : 7.4V
 
-# Control table address
-if MY_DXL == "X_SERIES" or MY_DXL == "MX_SERIES":
-    ADDR_TORQUE_ENABLE = 64
-    ADDR_GOAL_POSITION = 116
-    ADDR_GOAL_VELOCITY = 104
-    ADDR_PRESENT_POSITION = 132
-    ADDR_PRESENT_VELOCITY = 128
-    ADDR_POS_P_GAIN = 84
-    ADDR_GOAL_PWM = 100
-    ADDR_CHANGE_MODE = 11
-    ADDR_ID = 8
-    ADDR_PROFILE_ACCELERATION = 108
-    ADDR_PROFILE_VEL = 112
-
-    DXL_MINIMUM_POSITION_VALUE = (
-        0  # Refer to the Minimum Position Limit of product eManual
-    )
-    DXL_MAXIMUM_POSITION_VALUE = (
-        4095  # Refer to the Maximum Position Limit of product eManual
-    )
-    BAUDRATE = 115200
-
-    LEN_GOAL_POSITION = 4
-    LEN_GOAL_VELOCITY = 4
-
-elif MY_DXL == "PRO_SERIES":
-    ADDR_TORQUE_ENABLE = 562  # Control table address is different in DYNAMIXEL model
-    ADDR_GOAL_POSITION = 596
-    ADDR_PRESENT_POSITION = 611
-    DXL_MINIMUM_POSITION_VALUE = (
-        -150000)  # Refer to the Minimum Position Limit of product eManual
-    DXL_MAXIMUM_POSITION_VALUE = (
-        150000  # Refer to the Maximum Position Limit of product eManual
-    )
-    BAUDRATE = 57600
-elif MY_DXL == "P_SERIES" or MY_DXL == "PRO_A_SERIES":
-    ADDR_TORQUE_ENABLE = 512  # Control table address is different in DYNAMIXEL model
-    ADDR_GOAL_POSITION = 564
-    ADDR_PRESENT_POSITION = 580
-    DXL_MINIMUM_POSITION_VALUE = (
-        -150000)  # Refer to the Minimum Position Limit of product eManual
-    DXL_MAXIMUM_POSITION_VALUE = (
-        150000  # Refer to the Maximum Position Limit of product eManual
-    )
-    BAUDRATE = 57600
-elif MY_DXL == "XL320":
-    ADDR_TORQUE_ENABLE = 24
-    ADDR_GOAL_POSITION = 30
-    ADDR_PRESENT_POSITION = 37
-    DXL_MINIMUM_POSITION_VALUE = 0  # Refer to the CW Angle Limit of product eManual
-    DXL_MAXIMUM_POSITION_VALUE = 1023  # Refer to the CCW Angle Limit of product eManual
-    BAUDRATE = 1000000  # Default Baudrate of XL-320 is 1Mbps
+# シリーズごとのコントロールテーブル
+# アドレスがNoneの項目はそのシリーズにない。len_*はbyte数
+DxlModel = namedtuple("DxlModel", [
+    "name",
+    "torque_enable",
+    "operating_mode",
+    "goal_pwm",
+    "len_goal_pwm",
+    "goal_velocity",
+    "len_goal_velocity",
+    "goal_position",
+    "len_goal_position",
+    "present_velocity",
+    "len_present_velocity",
+    "present_position",
+    "len_present_position",
+    "pos_p_gain",
+    "len_pos_p_gain",
+    "profile_acceleration",
+    "profile_velocity",
+    "hardware_error_status",
+    "status_return_level",
+    "baud_rate",
+    "baud_rates",  # {baudrate: baud_rateに書く値}
+    "default_baudrate",
+    "min_position",
+    "max_position",
+])
+
+_X_BAUD_RATES = {
+    9600: 0,
+    57600: 1,
+    115200: 2,
+    1000000: 3,
+    2000000: 4,
+    3000000: 5,
+    4000000: 6,
+    4500000: 7,
+}
+
+DXL_MODELS = {}
+DXL_MODELS["X_SERIES"] = DxlModel(
+    name="X_SERIES",
+    torque_enable=64,
+    operating_mode=11,
+    goal_pwm=100,
+    len_goal_pwm=2,
+    goal_velocity=104,
+    len_goal_velocity=4,
+    goal_position=116,
+    len_goal_position=4,
+    present_velocity=128,
+    len_present_velocity=4,
+    present_position=132,
+    len_present_position=4,
+    pos_p_gain=84,
+    len_pos_p_gain=2,
+    profile_acceleration=108,
+    profile_velocity=112,
+    hardware_error_status=70,
+    status_return_level=68,
+    baud_rate=8,
+    baud_rates=_X_BAUD_RATES,
+    default_baudrate=115200,
+    min_position=0,
+    max_position=4095,
+)
+DXL_MODELS["MX_SERIES"] = DXL_MODELS["X_SERIES"]._replace(name="MX_SERIES")
+DXL_MODELS["PRO_SERIES"] = DxlModel(
+    name="PRO_SERIES",
+    torque_enable=562,
+    operating_mode=11,
+    goal_pwm=None,
+    len_goal_pwm=2,
+    goal_velocity=600,
+    len_goal_velocity=4,
+    goal_position=596,
+    len_goal_position=4,
+    present_velocity=615,
+    len_present_velocity=4,
+    present_position=611,
+    len_present_position=4,
+    pos_p_gain=594,
+    len_pos_p_gain=2,
+    profile_acceleration=606,  # Goal Acceleration
+    profile_velocity=None,
+    hardware_error_status=892,
+    status_return_level=891,
+    baud_rate=8,
+    # PROは0が2400bps (X seriesの9600ではない)
+    baud_rates={
+        2400: 0,
+        57600: 1,
+        115200: 2,
+        1000000: 3,
+        2000000: 4,
+        3000000: 5,
+        4000000: 6,
+        4500000: 7,
+        10500000: 8,
+    },
+    default_baudrate=57600,
+    min_position=-150000,
+    max_position=150000,
+)
+DXL_MODELS["P_SERIES"] = DxlModel(
+    name="P_SERIES",
+    torque_enable=512,
+    operating_mode=11,
+    goal_pwm=548,
+    len_goal_pwm=2,
+    goal_velocity=552,
+    len_goal_velocity=4,
+    goal_position=564,
+    len_goal_position=4,
+    present_velocity=576,
+    len_present_velocity=4,
+    present_position=580,
+    len_present_position=4,
+    pos_p_gain=532,
+    len_pos_p_gain=2,
+    profile_acceleration=556,
+    profile_velocity=560,
+    hardware_error_status=518,
+    status_return_level=516,
+    baud_rate=8,
+    baud_rates=_X_BAUD_RATES,
+    default_baudrate=57600,
+    min_position=-150000,
+    max_position=150000,
+)
+DXL_MODELS["PRO_A_SERIES"] = DXL_MODELS["P_SERIES"]._replace(
+    name="PRO_A_SERIES")
+DXL_MODELS["XL320"] = DxlModel(
+    name="XL320",
+    torque_enable=24,
+    operating_mode=11,  # Control Mode
+    goal_pwm=None,
+    len_goal_pwm=2,
+    goal_velocity=32,  # Moving Speed
+    len_goal_velocity=2,
+    goal_position=30,
+    len_goal_position=2,
+    present_velocity=39,
+    len_present_velocity=2,
+    present_position=37,
+    len_present_position=2,
+    pos_p_gain=29,
+    len_pos_p_gain=1,
+    profile_acceleration=None,
+    profile_velocity=None,
+    hardware_error_status=50,
+    status_return_level=17,
+    baud_rate=4,
+    baud_rates={
+        9600: 0,
+        57600: 1,
+        115200: 2,
+        1000000: 3
+    },
+    default_baudrate=1000000,  # Default Baudrate of XL-320 is 1Mbps
+    min_position=0,
+    max_position=1023,
+)
+
+# pingで返るモデル番号 -> シリーズ
+MODEL_NUMBERS = {}
+for _series, _numbers in (
+    ("X_SERIES", (1000, 1010, 1020, 1030, 1040, 1050, 1060, 1070, 1080,
+                  1090, 1100, 1110, 1120, 1130, 1140, 1150, 1160, 1170,
+                  1180, 1190, 1200, 1210, 1220, 1230, 1240, 1270, 1280)),
+    ("MX_SERIES", (30, 311, 321)),
+    ("PRO_SERIES", (35072, 37896, 37928, 38152, 38176, 43288, 46096,
+                    46352, 51200, 53768, 54024)),
+    ("PRO_A_SERIES", (43289, 46097, 46353, 51201, 53769, 54025)),
+    ("P_SERIES", (2000, 2010, 2020, 2100, 2110, 2120)),
+    ("XL320", (350,)),
+):
+    for _number in _numbers:
+        MODEL_NUMBERS[_number] = _series
+
+DEFAULT_MODEL = DXL_MODELS[MY_DXL]
+
+# Control table address (MY_DXLのシリーズ)
+ADDR_TORQUE_ENABLE = DEFAULT_MODEL.torque_enable
+ADDR_GOAL_POSITION = DEFAULT_MODEL.goal_position
+ADDR_GOAL_VELOCITY = DEFAULT_MODEL.goal_velocity
+ADDR_PRESENT_POSITION = DEFAULT_MODEL.present_position
+ADDR_PRESENT_VELOCITY = DEFAULT_MODEL.present_velocity
+ADDR_POS_P_GAIN = DEFAULT_MODEL.pos_p_gain
+ADDR_GOAL_PWM = DEFAULT_MODEL.goal_pwm
+ADDR_CHANGE_MODE = DEFAULT_MODEL.operating_mode
+ADDR_ID = 8
+ADDR_PROFILE_ACCELERATION = DEFAULT_MODEL.profile_acceleration
+ADDR_PROFILE_VEL = DEFAULT_MODEL.profile_velocity
+ADDR_HARDWARE_ERROR_STATUS = DEFAULT_MODEL.hardware_error_status
+ADDR_BAUD_RATE = DEFAULT_MODEL.baud_rate
+
+DXL_MINIMUM_POSITION_VALUE = DEFAULT_MODEL.min_position
+DXL_MAXIMUM_POSITION_VALUE = DEFAULT_MODEL.max_position
+BAUDRATE = DEFAULT_MODEL.default_baudrate
+
+LEN_GOAL_POSITION = DEFAULT_MODEL.len_goal_position
+LEN_GOAL_VELOCITY = DEFAULT_MODEL.len_goal_velocity
+
+
+def state_span(model):
+    """角度と速度をまとめて読むための連続した範囲
+
+    Args:
+        model (DxlModel)
+
+    Returns:
+        (開始アドレス, byte数)
+    """
+    start = min(model.present_position, model.present_velocity)
+    end = max(model.present_position + model.len_present_position,
+              model.present_velocity + model.len_present_velocity)
+    return start, end - start
+
+
+# ADDR_PRESENT_VELOCITY(128) から ADDR_PRESENT_POSITION(132) までの連続した8byte
+LEN_PRESENT_STATE = state_span(DEFAULT_MODEL)[1]
+
+
+def model_from_number(model_number):
+    """モデル番号からDxlModelを返す。知らない番号の場合DEFAULT_MODEL
+
+    Args:
+        model_number (int): pingで返るモデル番号
+
+    Returns:
+        DxlModel
+    """
+    series = MODEL_NUMBERS.get(model_number)
+    if series is None:
+        return DEFAULT_MODEL
+    return DXL_MODELS[series]
 
 
 def from_uint32_to_int32(value):
@@ -75,6 +267,14 @@ def from_uint32_to_int32(value):
     return value
 
 
+def to_signed(value, length):
+    """length byteの符号なし値を符号付きにする"""
+    bits = 8 * length
+    if value >= 1 << (bits - 1):
+        value -= 1 << bits
+    return value
+
+
 def goal_to_4byte(goal):
     """goalをバイト列に分割する
 
@@ -94,56 +294,594 @@ def goal_to_4byte(goal):
     return param_goal
 
 
-class dxl_controller:
-    """dynamixel controller class
+class dxl_bus:
+    """1つのシリアルポート (U2D2等) につながったdynamixelのチェーン
+    ポート、handler、GroupSyncWrite/Read、排他ロックをバスごとに持つ。
+    別のポートのバスは別のスレッドから並行して通信できる。
+    シリーズの違うサーボが混ざっている場合、sync write/readはアドレスごとに分けて送る
 
     Attributes:
+        port_name: ポート名
+        baudrate: 現在のボーレート
         portHandler:
         packetHandler:
-        groupSyncWrite_pos:
-        groupSyncWrite_vel:
-        dxl_id: dynamixel id
+        groupSyncWrite_pos: (MY_DXLのシリーズ用)
+        groupSyncWrite_vel: (MY_DXLのシリーズ用)
+        groupSyncRead_state: (MY_DXLのシリーズ用)
+        controllers: このバスにつながったサーボ {dxl_id: dxl_controller}
+        lock: このバスの通信の排他ロック
+        fire_and_forget: Trueの場合、書き込みでステータスパケットを待たない
+                         (write*TxOnly)。エラーはstart_verifyの確認読み出しで拾う。
+                         設定するとつながったサーボのStatus Return Levelを
+                         1 (read命令のみ応答) にし、Falseで2に戻す
+        errors: start_verifyで見つけたエラーのキュー
+                (time, dxl_id, dxl_comm_result, hardware_error_status)
+        errors_dropped: errorsが一杯で捨てたエラー数
     """
 
-    groupSyncWrite_pos = None
-    groupSyncWrite_vel = None
+    def __init__(self, port_name, baudrate=BAUDRATE, protocol_version=2.0,
+                 fire_and_forget=False, max_errors=1000):
+        self.port_name = port_name
+        self.baudrate = baudrate
+        self.portHandler = PortHandler(port_name)
+        self.packetHandler = PacketHandler(protocol_version)
+
+        # (address, length) -> GroupSyncWrite / GroupSyncRead
+        self._write_groups = {}
+        self._read_groups = {}
+        self._read_ids = {}  # (address, length) -> addParam済みのid
+
+        self.groupSyncWrite_pos = self.sync_write_group(
+            DEFAULT_MODEL.goal_position, DEFAULT_MODEL.len_goal_position)
+        self.groupSyncWrite_vel = self.sync_write_group(
+            DEFAULT_MODEL.goal_velocity, DEFAULT_MODEL.len_goal_velocity)
+        self.groupSyncRead_state = self.sync_read_group(
+            *state_span(DEFAULT_MODEL))
+
+        self.controllers = {}
+        self.lock = threading.Lock()
+        self._fire_and_forget = fire_and_forget
+
+        self.errors = queue.Queue(maxsize=max_errors)
+        self.errors_dropped = 0
+        self._verify_thread = None
+        self._verify_stop = threading.Event()
+
+        self.portHandler.openPort()
+        self.portHandler.setBaudRate(baudrate)
+
+    @property
+    def dxl_ids(self):
+        """このバスにつながったサーボのid"""
+        return list(self.controllers)
+
+    def attach(self, controller):
+        """サーボをこのバスに登録する
+        fire_and_forgetの場合はサーボのStatus Return Levelを1にする
+
+        Args:
+            controller (dxl_controller)
+        """
+        self.controllers[controller.dxl_id] = controller
+        if self._fire_and_forget:
+            failed_ids = self.set_status_return_level(1, [controller.dxl_id])
+            if failed_ids:
+                raise RuntimeError(
+                    "failed to set status return level of dxl_id %d" %
+                    controller.dxl_id)
+
+    @property
+    def fire_and_forget(self):
+        return self._fire_and_forget
+
+    @fire_and_forget.setter
+    def fire_and_forget(self, enabled):
+        # 書き込みへのステータスパケットが次のTxOnlyの送信とぶつからないように、
+        # 先にサーボ側の応答を止めてから切り替える
+        failed_ids = self.set_status_return_level(1 if enabled else 2)
+        if failed_ids:
+            raise RuntimeError("failed to set status return level of dxl_id " +
+                               ", ".join(str(dxl_id) for dxl_id in failed_ids))
+        self._fire_and_forget = enabled
+
+    def set_status_return_level(self, level, dxl_ids=None, settle=0.005):
+        """サーボのStatus Return Levelを設定し、読み出して確認する
+            0: pingのみ応答  1: read命令のみ応答  2: 全ての命令に応答
+
+        Args:
+            level (int): 0, 1, 2
+            dxl_ids (list[int]): 設定するid。Noneの場合このバスの全サーボ
+            settle (float): 書き込み後、応答を捨てるまでの待ち時間 [s]
+
+        Returns:
+            list[int]: 設定できなかったid
+        """
+        if dxl_ids is None:
+            dxl_ids = self.dxl_ids
+        ph = self.packetHandler
+        failed_ids = []
+        with self.lock:
+            for dxl_id in dxl_ids:
+                address = self.model_of(dxl_id).status_return_level
+                # 変更前後どちらのレベルで応答するか分からないので応答は待たずに捨てる
+                ph.write1ByteTxOnly(self.portHandler, dxl_id, address, level)
+                time.sleep(settle)
+                self.portHandler.clearPort()
+                value, dxl_comm_result, dxl_error = ph.read1ByteTxRx(
+                    self.portHandler, dxl_id, address)
+                if dxl_comm_result != COMM_SUCCESS or value != level:
+                    failed_ids.append(dxl_id)
+        return failed_ids
+
+    def model_of(self, dxl_id):
+        """サーボのDxlModel。登録されていないidはDEFAULT_MODEL"""
+        controller = self.controllers.get(dxl_id)
+        if controller is None:
+            return DEFAULT_MODEL
+        return controller.model
+
+    def ping_model(self, dxl_id):
+        """pingでモデル番号を調べ、DxlModelを返す
+
+        Returns:
+            DxlModel: 応答がないか知らない番号の場合DEFAULT_MODEL
+        """
+        with self.lock:
+            model_number, dxl_comm_result, dxl_error = self.packetHandler.ping(
+                self.portHandler, dxl_id)
+        if dxl_comm_result != COMM_SUCCESS:
+            return DEFAULT_MODEL
+        return model_from_number(model_number)
+
+    def sync_write_group(self, address, length):
+        """(address, length)のGroupSyncWriteを返す。なければ作る"""
+        key = (address, length)
+        group = self._write_groups.get(key)
+        if group is None:
+            group = self._write_groups.setdefault(
+                key,
+                GroupSyncWrite(self.portHandler, self.packetHandler, address,
+                               length))
+        return group
+
+    def sync_read_group(self, address, length):
+        """(address, length)のGroupSyncReadを返す。なければ作る"""
+        key = (address, length)
+        group = self._read_groups.get(key)
+        if group is None:
+            group = self._read_groups.setdefault(
+                key,
+                GroupSyncRead(self.portHandler, self.packetHandler, address,
+                              length))
+        return group
+
+    def write(self, dxl_id, length, address, value):
+        """1つのサーボのコントロールテーブルに書き込む
+        fire_and_forgetの場合はステータスパケットを待たない
+
+        Args:
+            length (int): 1, 2, 4 byte
+            address: コントロールテーブルアドレス
+            value: 値
+
+        Returns:
+            dxl_comm_result, dxl_error (fire_and_forgetの場合dxl_errorは0)
+        """
+        if address is None:
+            raise ValueError("address is not supported by dxl_id %d" % dxl_id)
+        ph = self.packetHandler
+        with self.lock:
+            if self._fire_and_forget:
+                if length == 1:
+                    dxl_comm_result = ph.write1ByteTxOnly(
+                        self.portHandler, dxl_id, address, value)
+                elif length == 2:
+                    dxl_comm_result = ph.write2ByteTxOnly(
+                        self.portHandler, dxl_id, address, value)
+                else:
+                    dxl_comm_result = ph.write4ByteTxOnly(
+                        self.portHandler, dxl_id, address, value)
+                return dxl_comm_result, 0
+
+            if length == 1:
+                return ph.write1ByteTxRx(self.portHandler, dxl_id, address,
+                                         value)
+            if length == 2:
+                return ph.write2ByteTxRx(self.portHandler, dxl_id, address,
+                                         value)
+            return ph.write4ByteTxRx(self.portHandler, dxl_id, address, value)
+
+    def read(self, dxl_id, length, address):
+        """1つのサーボのコントロールテーブルを読む
+
+        Returns:
+            value (符号付き), dxl_comm_result, dxl_error
+        """
+        if address is None:
+            raise ValueError("address is not supported by dxl_id %d" % dxl_id)
+        ph = self.packetHandler
+        with self.lock:
+            if length == 1:
+                value, dxl_comm_result, dxl_error = ph.read1ByteTxRx(
+                    self.portHandler, dxl_id, address)
+            elif length == 2:
+                value, dxl_comm_result, dxl_error = ph.read2ByteTxRx(
+                    self.portHandler, dxl_id, address)
+            else:
+                value, dxl_comm_result, dxl_error = ph.read4ByteTxRx(
+                    self.portHandler, dxl_id, address)
+        return to_signed(value, length), dxl_comm_result, dxl_error
+
+    def sync_write(self, goals, field="goal_position"):
+        """複数サーボへの目標値を1回のロックで組み立てて送信する
+        パラメータはnumpyでまとめてバイト列にする。
+        目標角度の場合、mode 4のサーボは初期化時の位置を足す。
+        シリーズによってアドレスが違う場合はアドレスごとにsync writeを送る
+
+        Args:
+            goals (dict): {dxl_id: 目標値}
+            field (str): "goal_position" or "goal_velocity"
+
+        Returns:
+            dxl_comm_result
+            failed_ids (list[int]): 送信できなかったid。通信失敗時はそのsync writeの全id
+        """
+        if field not in ("goal_position", "goal_velocity"):
+            raise ValueError("unsupported field: " + str(field))
+
+        dxl_ids = list(goals)
+        values = np.rint(
+            np.fromiter(goals.values(), dtype=np.float64,
+                        count=len(dxl_ids))).astype(np.int64)
+        if field == "goal_position":
+            values += np.fromiter(
+                (self._initialize_pos(dxl_id) for dxl_id in dxl_ids),
+                dtype=np.int64,
+                count=len(dxl_ids))
+        # int32リトルエンディアンの4byteを1行ずつのリストにする
+        params = values.astype("<i4").view(np.uint8).reshape(-1, 4).tolist()
+
+        # (address, length) -> [(dxl_id, param), ...]
+        batches = {}
+        for dxl_id, param in zip(dxl_ids, params):
+            model = self.model_of(dxl_id)
+            key = (getattr(model, field), getattr(model, "len_" + field))
+            batches.setdefault(key, []).append((dxl_id, param[:key[1]]))
+
+        result = COMM_SUCCESS
+        failed_ids = []
+        with self.lock:
+            for (address, length), entries in batches.items():
+                group = self.sync_write_group(address, length)
+                group.clearParam()
+                added = []
+                for dxl_id, param in entries:
+                    if group.addParam(dxl_id, param):
+                        added.append(dxl_id)
+                    else:
+                        failed_ids.append(dxl_id)
+                dxl_comm_result = group.txPacket()
+                group.clearParam()
+                if dxl_comm_result != COMM_SUCCESS:
+                    result = dxl_comm_result
+                    failed_ids += added
+        return result, failed_ids
+
+    def sync_write_pos(self, goals):
+        """目標角度をまとめて送信する (sync_write)"""
+        return self.sync_write(goals, "goal_position")
+
+    def sync_write_vel(self, goals):
+        """目標速度をまとめて送信する (sync_write)"""
+        return self.sync_write(goals, "goal_velocity")
+
+    def _initialize_pos(self, dxl_id):
+        controller = self.controllers.get(dxl_id)
+        if controller is None or controller.mode != 4:
+            return 0
+        return controller.initialize_pos
+
+    def _write_group_keys(self, field):
+        keys = {(getattr(controller.model, field),
+                 getattr(controller.model, "len_" + field))
+                for controller in self.controllers.values()}
+        return keys or {(getattr(DEFAULT_MODEL, field),
+                         getattr(DEFAULT_MODEL, "len_" + field))}
+
+    def _write_groups_of(self, field):
+        with self.lock:
+            for address, length in self._write_group_keys(field):
+                group = self.sync_write_group(address, length)
+                group.txPacket()
+                group.clearParam()
+
+    def write_group_pos(self):
+        """add済みの目標角度をまとめて送信する"""
+        self._write_groups_of("goal_position")
+
+    def write_group_vel(self):
+        """add済みの目標速度をまとめて送信する"""
+        self._write_groups_of("goal_velocity")
+
+    def _sync_read(self, address, length, dxl_ids):
+        # lock内で呼ぶ。読むidが変わった時だけparamを作り直す
+        key = (address, length)
+        group = self.sync_read_group(address, length)
+        if self._read_ids.get(key) != dxl_ids:
+            group.clearParam()
+            for dxl_id in dxl_ids:
+                group.addParam(dxl_id)
+            self._read_ids[key] = dxl_ids
+        return group, group.txRxPacket()
+
+    def read_group_state(self, dxl_ids=None):
+        """GroupSyncReadで複数サーボの角度と速度を1回の通信で読む
+        シリーズの違うサーボはシリーズごとに読む
+
+        Args:
+            dxl_ids (list[int]): 読むサーボのid。Noneの場合このバスの全サーボ
+
+        Returns:
+            state (np.ndarray): shape (n, 2) int32 [[角度, 速度], ...]
+                                読めなかったサーボの行は0
+            valid (np.ndarray): shape (n,) bool 読めたサーボの行がTrue
+            dxl_comm_result
+        """
+        if dxl_ids is None:
+            dxl_ids = self.dxl_ids
+
+        # (address, length) -> [(行, dxl_id, model), ...]
+        spans = {}
+        for i, dxl_id in enumerate(dxl_ids):
+            model = self.model_of(dxl_id)
+            spans.setdefault(state_span(model), []).append((i, dxl_id, model))
+
+        state = np.zeros((len(dxl_ids), 2), dtype=np.int32)
+        valid = np.zeros(len(dxl_ids), dtype=bool)
+        result = COMM_SUCCESS
+        with self.lock:
+            for (address, length), entries in spans.items():
+                group, dxl_comm_result = self._sync_read(
+                    address, length,
+                    tuple(dxl_id for _, dxl_id, _ in entries))
+                if dxl_comm_result != COMM_SUCCESS:
+                    result = dxl_comm_result
+                for i, dxl_id, model in entries:
+                    if not group.isAvailable(dxl_id, address, length):
+                        continue
+                    state[i, 0] = to_signed(
+                        group.getData(dxl_id, model.present_position,
+                                      model.len_present_position),
+                        model.len_present_position)
+                    state[i, 1] = to_signed(
+                        group.getData(dxl_id, model.present_velocity,
+                                      model.len_present_velocity),
+                        model.len_present_velocity)
+                    valid[i] = True
+        return state, valid, result
+
+    def verify(self):
+        """全サーボのハードウェアエラーステータスを1回のsync readで確認する
+        通信できなかったサーボとエラーのあるサーボをerrorsに入れる
+
+        Returns:
+            int: 見つけたエラー数
+        """
+        # address -> [dxl_id, ...]
+        addresses = {}
+        for dxl_id in self.dxl_ids:
+            addresses.setdefault(
+                self.model_of(dxl_id).hardware_error_status, []).append(dxl_id)
+
+        found = []
+        with self.lock:
+            for address, dxl_ids in addresses.items():
+                group, dxl_comm_result = self._sync_read(
+                    address, 1, tuple(dxl_ids))
+                for dxl_id in dxl_ids:
+                    if not group.isAvailable(dxl_id, address, 1):
+                        found.append((dxl_id, dxl_comm_result, None))
+                        continue
+                    status = group.getData(dxl_id, address, 1)
+                    if status:
+                        found.append((dxl_id, dxl_comm_result, status))
+
+        now = time.time()
+        for dxl_id, dxl_comm_result, status in found:
+            try:
+                self.errors.put_nowait((now, dxl_id, dxl_comm_result, status))
+            except queue.Full:
+                self.errors_dropped += 1
+        return len(found)
+
+    def start_verify(self, period=0.1):
+        """verifyをperiod秒ごとに実行するスレッドを開始する
+
+        Args:
+            period (float): 確認周期 [s]
+        """
+        if self._verify_thread is not None:
+            return
+        self._verify_stop.clear()
+        self._verify_thread = threading.Thread(target=self._verify_loop,
+                                               args=(period,),
+                                               daemon=True)
+        self._verify_thread.start()
+
+    def stop_verify(self):
+        """確認スレッドを止める"""
+        if self._verify_thread is None:
+            return
+        self._verify_stop.set()
+        self._verify_thread.join()
+        self._verify_thread = None
+
+    def _verify_loop(self, period):
+        while not self._verify_stop.wait(period):
+            self.verify()
+
+    def set_baudrate(self, baudrate, settle=0.05):
+        """バス上の全サーボとポートのボーレートを変更する
+        ボーレートはEEPROM領域のため一度トルクを切り、変更後に全サーボへpingして確認する。
+        応答しないサーボがあれば元のボーレートに戻す
+
+        Args:
+            baudrate (int): 新しいボーレート (1000000, 2000000, 3000000, 4000000等)
+            settle (float): ボーレート変更後、pingまでの待ち時間 [s]
+
+        Returns:
+            bool: 変更できたか (Falseの場合は元のボーレートに戻っている)
+
+        Raises:
+            ValueError: ポートまたはサーボが対応していないボーレートの場合
+            RuntimeError: 元のボーレートにも戻せなかった場合
+        """
+        old_baudrate = self.baudrate
+        if baudrate == old_baudrate:
+            return True
+        if self.portHandler.getCFlagBaud(baudrate) <= 0:
+            raise ValueError("port does not support baudrate %d" % baudrate)
+        models = {dxl_id: self.model_of(dxl_id) for dxl_id in self.dxl_ids}
+        for dxl_id, model in models.items():
+            if baudrate not in model.baud_rates:
+                raise ValueError("dxl_id %d (%s) does not support baudrate %d"
+                                 % (dxl_id, model.name, baudrate))
+
+        ph = self.packetHandler
+        port = self.portHandler
+
+        def write_all(address_of, value_of):
+            # Status Return Levelやボーレートの切り替わりで応答の有無・速度が
+            # 変わるため、応答は待たずに捨てる
+            for dxl_id, model in models.items():
+                ph.write1ByteTxOnly(port, dxl_id, address_of(model),
+                                    value_of(dxl_id, model))
+            time.sleep(settle)
+            port.clearPort()
+
+        def ping_all():
+            return all(
+                ph.ping(port, dxl_id)[1] == COMM_SUCCESS for dxl_id in models)
+
+        with self.lock:
+            torque = {}
+            for dxl_id, model in models.items():
+                torque[dxl_id], _, _ = ph.read1ByteTxRx(
+                    port, dxl_id, model.torque_enable)
+            write_all(lambda model: model.torque_enable,
+                      lambda dxl_id, model: 0)
+
+            write_all(lambda model: model.baud_rate,
+                      lambda dxl_id, model: model.baud_rates[baudrate])
+            port.setBaudRate(baudrate)
+            time.sleep(settle)
+            ok = ping_all()
+
+            if not ok:
+                # 応答を受け取れなくても切り替わったサーボがあるので、
+                # 新しいボーレートで全サーボに元の値を書いてからポートを戻す
+                write_all(lambda model: model.baud_rate,
+                          lambda dxl_id, model: model.baud_rates[old_baudrate])
+                port.setBaudRate(old_baudrate)
+                time.sleep(settle)
+                port.clearPort()
+                restored = ping_all()
+
+            write_all(lambda model: model.torque_enable,
+                      lambda dxl_id, model: 1 if torque[dxl_id] else 0)
+
+        if not ok and not restored:
+            raise RuntimeError(
+                "failed to restore baudrate %d on %s" %
+                (old_baudrate, self.port_name))
+        if ok:
+            self.baudrate = baudrate
+        return ok
+
+    def close(self):
+        """ポートを閉じ、get_busの登録から外す"""
+        self.stop_verify()
+        self.portHandler.closePort()
+        with _buses_lock:
+            if _buses.get(self.port_name) is self:
+                del _buses[self.port_name]
+
+
+# port_name -> dxl_bus
+_buses = {}
+_buses_lock = threading.Lock()
 
-    portHandler = None
-    packetHandler = None
 
-    _lock = threading.Lock()
+def get_bus(port_name):
+    """port_nameのdxl_busを返す。なければ作成する
+
+    Args:
+        port_name (str): ポート名
+
+    Returns:
+        dxl_bus
+    """
+    with _buses_lock:
+        bus = _buses.get(port_name)
+        if bus is None:
+            bus = dxl_bus(port_name)
+            _buses[port_name] = bus
+        return bus
 
-    def __init__(self, port_name, dxl_id, mode):
-        PROTOCOL_VERSION = 2.0
 
-        if dxl_controller.portHandler == None:
+class dxl_controller:
+    """dynamixel controller class
+    通信はサーボがつながったdxl_busを通して行う。
+    busを指定しない場合はport_nameごとに共有のdxl_busを使う
+
+    Attributes:
+        bus: dxl_bus
+        dxl_id: dynamixel id
+        model: DxlModel。指定しない場合pingのモデル番号から決める
+    """
 
-            dxl_controller.portHandler = PortHandler(port_name)
-            dxl_controller.packetHandler = PacketHandler(PROTOCOL_VERSION)
+    def __init__(self, port_name, dxl_id, mode, bus=None, model=None):
+        if bus is None:
+            bus = get_bus(port_name)
+        self.bus = bus
 
-            dxl_controller.groupSyncWrite_pos = GroupSyncWrite(
-                dxl_controller.portHandler,
-                dxl_controller.packetHandler,
-                ADDR_GOAL_POSITION,
-                LEN_GOAL_POSITION,
-            )
-            dxl_controller.groupSyncWrite_vel = GroupSyncWrite(
-                dxl_controller.portHandler,
-                dxl_controller.packetHandler,
-                ADDR_GOAL_VELOCITY,
-                LEN_GOAL_VELOCITY,
-            )
-            dxl_controller.portHandler.openPort()
-            dxl_controller.portHandler.setBaudRate(BAUDRATE)
+        if model is None:
+            model = bus.ping_model(dxl_id)
+        elif isinstance(model, str):
+            model = DXL_MODELS[model]
+        self.model = model
 
         self.initialize_pos = 0
 
         self.dxl_id = dxl_id
         self.mode = mode
+        bus.attach(self)
         self.set_torque(0)
         self.set_mode()
         self.set_torque(1)
 
+    @property
+    def portHandler(self):
+        return self.bus.portHandler
+
+    @property
+    def packetHandler(self):
+        return self.bus.packetHandler
+
+    @property
+    def groupSyncWrite_pos(self):
+        return self.bus.sync_write_group(self.model.goal_position,
+                                         self.model.len_goal_position)
+
+    @property
+    def groupSyncWrite_vel(self):
+        return self.bus.sync_write_group(self.model.goal_velocity,
+                                         self.model.len_goal_velocity)
+
+    @property
+    def groupSyncRead_state(self):
+        return self.bus.sync_read_group(*state_span(self.model))
+
     def set_torque(self, torque):
         """set_torque
 
@@ -154,11 +892,8 @@ class dxl_controller:
         Returns:
             result,error
         """
-        with dxl_controller._lock:
-            dxl_comm_result, dxl_error = dxl_controller.packetHandler.write1ByteTxRx(
-                dxl_controller.portHandler, self.dxl_id, ADDR_TORQUE_ENABLE,
-                torque)
-        return dxl_comm_result, dxl_error
+        return self.bus.write(self.dxl_id, 1, self.model.torque_enable,
+                              torque)
 
     def set_mode(self):
         """mode     value
@@ -171,11 +906,8 @@ class dxl_controller:
         if self.mode == 4:
             self.initialize_pos = self.read_pos()
 
-        with dxl_controller._lock:
-            dxl_comm_result, dxl_error = dxl_controller.packetHandler.write1ByteTxRx(
-                dxl_controller.portHandler, self.dxl_id, ADDR_CHANGE_MODE,
-                self.mode)
-        return dxl_comm_result, dxl_error
+        return self.bus.write(self.dxl_id, 1, self.model.operating_mode,
+                              self.mode)
 
     def write_pos(self, goal_pos):
         # absolute goal_pos range is 0 ~ 4095
@@ -185,92 +917,256 @@ class dxl_controller:
         if self.mode == 4:
             goal_pos = goal_pos + self.initialize_pos
 
-        with dxl_controller._lock:
-            dxl_comm_result, dxl_error = dxl_controller.packetHandler.write4ByteTxRx(
-                dxl_controller.portHandler, self.dxl_id, ADDR_GOAL_POSITION,
-                goal_pos)
-        return dxl_comm_result, dxl_error
+        return self.bus.write(self.dxl_id, self.model.len_goal_position,
+                              self.model.goal_position, goal_pos)
 
     def write_vel(self, goal_vel):
         # goal_vel range is 0~1023
-        with dxl_controller._lock:
-            dxl_comm_result, dxl_error = dxl_controller.packetHandler.write4ByteTxRx(
-                dxl_controller.portHandler, self.dxl_id, ADDR_GOAL_VELOCITY,
-                goal_vel)
-        return dxl_comm_result, dxl_error
+        return self.bus.write(self.dxl_id, self.model.len_goal_velocity,
+                              self.model.goal_velocity, goal_vel)
 
     def write_profile_vel(self, profile_vel):
-        with dxl_controller._lock:
-            dxl_comm_result, dxl_error = dxl_controller.packetHandler.write4ByteTxRx(
-                dxl_controller.portHandler, self.dxl_id, ADDR_PROFILE_VEL,
-                profile_vel)
-        return dxl_comm_result, dxl_error
+        return self.bus.write(self.dxl_id, 4, self.model.profile_velocity,
+                              profile_vel)
 
     def write_profile_accel(self, profile_accel):
-        with dxl_controller._lock:
-            dxl_comm_result, dxl_error = dxl_controller.packetHandler.write4ByteTxRx(
-                dxl_controller.portHandler, self.dxl_id,
-                ADDR_PROFILE_ACCELERATION, profile_accel)
-        return dxl_comm_result, dxl_error
+        return self.bus.write(self.dxl_id, 4, self.model.profile_acceleration,
+                              profile_accel)
 
     def write_pos_p_gain(self, p_gain):
-        with dxl_controller._lock:
-            dxl_comm_result, dxl_error = dxl_controller.packetHandler.write2ByteTxRx(
-                dxl_controller.portHandler, self.dxl_id, ADDR_POS_P_GAIN,
-                p_gain)
-        return dxl_comm_result, dxl_error
+        return self.bus.write(self.dxl_id, self.model.len_pos_p_gain,
+                              self.model.pos_p_gain, p_gain)
 
     def add_sync_param_pos(self, goal_pos):
-        """
+        """目標角度をGroupSyncWriteに追加する
 
         Args:
-            goal_pos ([TODO:parameter]): [TODO:description]
+            goal_pos (int32): 目標角度
+
+        Returns:
+            bool: 追加できたか (同じidが追加済みの場合False)
         """
 
         if self.mode == 4:
             goal_pos = goal_pos + self.initialize_pos
-        param_goal_pos = goal_to_4byte(goal_pos)
-        dxl_controller.groupSyncWrite_pos.addParam(self.dxl_id, param_goal_pos)
+        param_goal_pos = goal_to_4byte(goal_pos)[:self.model.len_goal_position]
+        with self.bus.lock:
+            return self.groupSyncWrite_pos.addParam(self.dxl_id,
+                                                    param_goal_pos)
 
     def write_group_dyna_pos(self):
-        with dxl_controller._lock:
-            dxl_controller.groupSyncWrite_pos.txPacket()
-            dxl_controller.groupSyncWrite_pos.clearParam()
+        self.bus.write_group_pos()
 
     def add_sync_param_vel(self, goal_vel):
-        param_goal_vel = goal_to_4byte(goal_vel)
-        dxl_controller.groupSyncWrite_vel.addParam(self.dxl_id, param_goal_vel)
+        """目標速度をGroupSyncWriteに追加する
+
+        Returns:
+            bool: 追加できたか (同じidが追加済みの場合False)
+        """
+        param_goal_vel = goal_to_4byte(goal_vel)[:self.model.len_goal_velocity]
+        with self.bus.lock:
+            return self.groupSyncWrite_vel.addParam(self.dxl_id,
+                                                    param_goal_vel)
 
     def write_group_dyna_vel(self):
-        with dxl_controller._lock:
-            dxl_controller.groupSyncWrite_vel.txPacket()
-            dxl_controller.groupSyncWrite_vel.clearParam()
+        self.bus.write_group_vel()
 
     def write_goal_pwm(self, goal_pwm):
-        with dxl_controller._lock:
-            dxl_comm_result, dxl_error = dxl_controller.packetHandler.write2ByteTxRx(
-                dxl_controller.portHandler, self.dxl_id, ADDR_GOAL_PWM,
-                goal_pwm)
-        return dxl_comm_result, dxl_error
+        return self.bus.write(self.dxl_id, self.model.len_goal_pwm,
+                              self.model.goal_pwm, goal_pwm)
 
     def read_pos(self):
-        with dxl_controller._lock:
-            dxl_present_position, dxl_comm_result, dxl_error = (
-                dxl_controller.packetHandler.read4ByteTxRx(
-                    dxl_controller.portHandler, self.dxl_id,
-                    ADDR_PRESENT_POSITION))
-        dxl_present_position = from_uint32_to_int32(dxl_present_position)
+        dxl_present_position, dxl_comm_result, dxl_error = self.bus.read(
+            self.dxl_id, self.model.len_present_position,
+            self.model.present_position)
         return dxl_present_position
 
     def read_vel(self):
-        with dxl_controller._lock:
-            dxl_present_velocity, dxl_comm_result, dxl_error = (
-                dxl_controller.packetHandler.read4ByteTxRx(
-                    dxl_controller.portHandler, self.dxl_id,
-                    ADDR_PRESENT_VELOCITY))
-
-        dxl_present_velocity = from_uint32_to_int32(dxl_present_velocity)
+        dxl_present_velocity, dxl_comm_result, dxl_error = self.bus.read(
+            self.dxl_id, self.model.len_present_velocity,
+            self.model.present_velocity)
         return dxl_present_velocity
 
+    def read_group_state(self, dxl_ids=None):
+        """このサーボのバスでread_group_stateする (dxl_bus.read_group_state)"""
+        return self.bus.read_group_state(dxl_ids)
+
     def close_port(self):
-        dxl_controller.portHandler.closePort()
+        self.bus.close()
+
+
+class dxl_trajectory_player:
+    """時刻付きの目標値列を一定周期のsync writeで再生する
+    周期は開始時刻からの絶対時刻で決めるため、sleepの誤差が積み重ならない。
+    1周期が間に合わなかった場合は遅れた周期を飛ばしてoverrunsに数える
+
+    使い方:
+        player = dxl_trajectory_player(bus, [1, 2], times, targets, rate=200)
+        player.start()
+        player.wait()
+        print(player.stats())
+
+    Args:
+        bus (dxl_bus): 送信するバス
+        dxl_ids (list[int]): targetsの列に対応するid
+        times (np.ndarray): shape (T,) 開始からの時刻 [s] (単調増加)
+        targets (np.ndarray): shape (T, n) 各時刻の目標値
+        rate (float): 送信周期 [Hz]
+        field (str): "goal_position" or "goal_velocity"
+        interpolate (bool): Trueの場合時刻の間を線形補間、Falseの場合直前の値
+        spin (float): 周期の直前この時間 [s] はsleepせずに待つ
+    """
+
+    # 遅れのヒストグラムの区切り [s]
+    LATENCY_BINS = np.array(
+        [0, 50e-6, 100e-6, 200e-6, 500e-6, 1e-3, 2e-3, 5e-3, 10e-3, np.inf])
+
+    def __init__(self, bus, dxl_ids, times, targets, rate=100.0,
+                 field="goal_position", interpolate=True, spin=0.0005):
+        self.bus = bus
+        self.dxl_ids = list(dxl_ids)
+        self.times = np.asarray(times, dtype=np.float64)
+        self.targets = np.asarray(targets, dtype=np.float64).reshape(
+            len(self.times), len(self.dxl_ids))
+        self.period = 1.0 / rate
+        self.field = field
+        self.interpolate = interpolate
+        self.spin = spin
+
+        if len(self.times) == 0:
+            raise ValueError("times is empty")
+        if np.any(np.diff(self.times) < 0):
+            raise ValueError("times must be increasing")
+
+        # 浮動小数点の誤差で最後の周期を落とさないよう少し余裕を持たせる
+        n_ticks = int(math.floor(self.times[-1] / self.period + 1e-9)) + 1
+        self._ticks = np.arange(n_ticks) * self.period
+        # 最後の時刻が周期の途中の場合は、最後の目標値を送る周期を加える
+        if self._ticks[-1] < self.times[-1] - 1e-9:
+            self._ticks = np.append(self._ticks, self.times[-1])
+        self._latency = np.zeros(len(self._ticks))  # 予定時刻から送信開始までの遅れ
+        self._write_time = np.zeros(len(self._ticks))  # sync writeにかかった時間
+        self._send_time = np.zeros(len(self._ticks))  # 開始から送信開始までの時間
+        self._reset()
+
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _reset(self):
+        self._count = 0
+        self.overruns = 0
+        self.failed = 0  # 送信できなかったidの延べ数
+
+    def target_at(self, t):
+        """時刻tの目標値
+
+        Returns:
+            np.ndarray: shape (n,)
+        """
+        if self.interpolate:
+            i = np.searchsorted(self.times, t, side="right")
+            if i == 0:
+                return self.targets[0]
+            if i >= len(self.times):
+                return self.targets[-1]
+            t0, t1 = self.times[i - 1], self.times[i]
+            ratio = (t - t0) / (t1 - t0) if t1 > t0 else 1.0
+            return self.targets[i - 1] + (self.targets[i] -
+                                          self.targets[i - 1]) * ratio
+        i = max(np.searchsorted(self.times, t, side="right") - 1, 0)
+        return self.targets[i]
+
+    def start(self):
+        """再生スレッドを開始する。再生済みの場合は統計を消して最初から再生する"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._reset()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def wait(self, timeout=None):
+        """再生の終了を待つ
+
+        Returns:
+            bool: 終了したか
+        """
+        if self._thread is None:
+            return True
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def stop(self):
+        """再生を途中で止める"""
+        self._stop.set()
+        self.wait()
+        self._thread = None
+
+    def _run(self):
+        start = time.perf_counter()
+        n_ticks = len(self._ticks)
+        k = 0
+        while k < n_ticks and not self._stop.is_set():
+            deadline = start + self._ticks[k]
+            # 直前まではsleepし、残りは待ち続けて周期のずれを小さくする
+            remaining = deadline - time.perf_counter()
+            if remaining > self.spin:
+                if self._stop.wait(remaining - self.spin):
+                    break
+            while time.perf_counter() < deadline:
+                pass
+
+            now = time.perf_counter()
+            goals = dict(zip(self.dxl_ids, self.target_at(now - start)))
+            _, failed_ids = self.bus.sync_write(goals, self.field)
+            done = time.perf_counter()
+
+            self._latency[self._count] = now - deadline
+            self._write_time[self._count] = done - now
+            self._send_time[self._count] = now - start
+            self._count += 1
+            self.failed += len(failed_ids)
+
+            # 次の周期が過ぎていたら飛ばす (最後の周期は必ず送る)
+            next_k = min(
+                int(np.searchsorted(self._ticks, done - start, side="right")),
+                n_ticks - 1)
+            if next_k > k + 1:
+                self.overruns += next_k - (k + 1)
+            k = max(next_k, k + 1)
+
+    def stats(self):
+        """再生の統計
+
+        Returns:
+            dict:
+                ticks          : 送信した回数
+                overruns       : 間に合わず飛ばした周期数
+                failed         : 送信できなかったidの延べ数
+                target_rate    : 指定した周期 [Hz]
+                achieved_rate  : 実際の送信周期 [Hz] (最初と最後の送信の間隔から求める)
+                latency_hist   : (counts, bins) 予定時刻からの遅れ [s] のヒストグラム
+                latency_max    : 遅れの最大 [s]
+                write_time_mean: sync writeにかかった時間の平均 [s]
+                write_time_max : sync writeにかかった時間の最大 [s]
+        """
+        n = self._count
+        latency = self._latency[:n]
+        write_time = self._write_time[:n]
+        achieved_rate = 0.0
+        if n > 1:
+            # n回の送信の間はn - 1周期
+            achieved_rate = (n - 1) / max(
+                self._send_time[n - 1] - self._send_time[0], 1e-9)
+        counts, _ = np.histogram(latency, self.LATENCY_BINS)
+        return {
+            "ticks": n,
+            "overruns": self.overruns,
+            "failed": self.failed,
+            "target_rate": 1.0 / self.period,
+            "achieved_rate": achieved_rate,
+            "latency_hist": (counts, self.LATENCY_BINS),
+            "latency_max": float(latency.max()) if n else 0.0,
+            "write_time_mean": float(write_time.mean()) if n else 0.0,
+            "write_time_max": float(write_time.max()) if n else 0.0,
+        }
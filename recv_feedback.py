@@ -5,20 +5,11 @@ import time
 import struct
 import numpy as np
 
-
-def calc_checksum(packet_data):
-    """排他的論理和チェックサムを計算する
-
-    Args:
-        packet_data (Iterable[int]): パケットデータ
-
-    Returns:
-        チェックサム値
-    """
-    checksum_val = 0
-    for i in range(0, len(packet_data)):
-        checksum_val ^= packet_data[i]
-    return checksum_val
+# パッケージとしても、このディレクトリから単体でもimportできるようにする
+try:
+    from .ah_framing import calc_checksum
+except ImportError:
+    from ah_framing import calc_checksum
 
 
 def receive_packet(struct_format, ser):
@@ -68,3 +59,105 @@ def receive_packet(struct_format, ser):
     packet = struct.unpack(struct_format, full_packet_bin)
 
     return packet
+
+
+class FeedbackDecoder:
+    """esp32からのfeedbackパケットをまとめて受信・デコードする
+    struct_formatは最初に1度だけコンパイルし、受信キューにある分を1回のreadで読み込む。
+    連続して並んだパケットはheaderとチェックサムをnumpyでまとめて確認し、
+    iter_unpackで一括変換する。エラーはprintせずstatsに数える
+
+    使い方:
+        decoder = FeedbackDecoder("<BiiB")
+        while True:
+            for packet in decoder.read(ser):
+                ...
+
+    Attributes:
+        packet_struct: コンパイル済みのstruct_format
+        packet_len: パケット長さ
+        stats: 受信統計
+            packets        : デコードしたパケット数
+            header_error   : headerが誤っていた回数
+            checksum_error : チェックサムが正しくなかった回数
+            bytes_dropped  : 同期のために読み飛ばしたバイト数
+    """
+
+    HEADER = 0xAA
+
+    def __init__(self, struct_format):
+        self.packet_struct = struct.Struct(struct_format)
+        self.packet_len = self.packet_struct.size
+        self.stats = {
+            "packets": 0,
+            "header_error": 0,
+            "checksum_error": 0,
+            "bytes_dropped": 0,
+        }
+        self._buf = bytearray()
+
+    def _count_valid(self, pos, n_packets):
+        # pos から並んでいるn_packets個のうち、先頭から正しいパケットの数を返す
+        block = np.frombuffer(self._buf, np.uint8, n_packets * self.packet_len,
+                              pos).reshape(n_packets, self.packet_len)
+        valid = (block[:, 0] == self.HEADER) & (np.bitwise_xor.reduce(
+            block, axis=1) == 0)
+        if valid.all():
+            return n_packets
+        return int(valid.argmin())
+
+    def feed(self, data):
+        """受信データを追加し、完成したパケットをデコードする
+
+        Args:
+            data (bytes): 受信データ
+
+        Returns:
+            list[tuple]: デコードしたパケットのリスト
+        """
+        buf = self._buf
+        buf += data
+        stats = self.stats
+        packet_len = self.packet_len
+        packets = []
+
+        pos = 0
+        while True:
+            n_packets = (len(buf) - pos) // packet_len
+            if n_packets == 0:
+                break
+
+            n_valid = self._count_valid(pos, n_packets)
+            if n_valid:
+                end = pos + n_valid * packet_len
+                packets.extend(self.packet_struct.iter_unpack(buf[pos:end]))
+                stats["packets"] += n_valid
+                pos = end
+            if n_valid == n_packets:
+                break
+
+            # 壊れたパケットは次のheaderまで読み飛ばして同期し直す
+            if buf[pos] != self.HEADER:
+                stats["header_error"] += 1
+            else:
+                stats["checksum_error"] += 1
+            next_pos = buf.find(self.HEADER, pos + 1)
+            if next_pos < 0:
+                next_pos = len(buf)
+            stats["bytes_dropped"] += next_pos - pos
+            pos = next_pos
+
+        del buf[:pos]
+        return packets
+
+    def read(self, ser):
+        """受信キューにあるデータを1回のreadで読み込み、デコードする
+        受信キューが空の場合は1パケット分serのタイムアウトまで待つ
+
+        Args:
+            ser (Serial): シリアルインスタンス
+
+        Returns:
+            list[tuple]: デコードしたパケットのリスト
+        """
+        return self.feed(ser.read(ser.in_waiting or self.packet_len))